@@ -1,6 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
+import time
 import urllib
+import zipfile
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# Responses that are worth retrying, as the server may recover.
+RETRY_STATUSES = {502, 503, 504}
 
 
 class BadRequest(Exception):
@@ -20,10 +29,14 @@ class ProgImageApi:
         url = self._build_url(path, query_args)
         return requests.get(url)
 
-    def _post(self, path, query_args, files=None):
+    def _post(self, path, query_args=None, files=None):
         url = self._build_url(path, query_args)
         return requests.post(url, files=files)
 
+    def _post_json(self, path, payload):
+        url = self._build_url(path)
+        return requests.post(url, json=payload)
+
     def upload_from_file(self, path):
         """
         Uploads the image at the given path to progimage.
@@ -48,6 +61,108 @@ class ProgImageApi:
             raise BadRequest("Must include an image_id or url when using get_image")
         return self._get("/image", get_image_kwargs)
 
+    def get_images(self, jobs):
+        """
+        Gets many images in one request. Each job is a dict with an image_id or
+        url, and any of the effects get_image accepts.
+
+        The response is a zip file, which read_batch can unpack.
+        """
+        for job in jobs:
+            if not (job.get("image_id") or job.get("url")):
+                raise BadRequest("Each job must include an image_id or url")
+        return self._post_json("/batch", {"jobs": jobs})
+
+
+class PooledProgImageApi(ProgImageApi):
+    """
+    A ProgImageApi that keeps connections alive between requests, retries
+    requests that fail, and can make many requests concurrently.
+    """
+
+    def __init__(self, concurrency=8, retries=3, backoff=0.5, timeout=30):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _get(self, path, query_args=None):
+        return self._request("GET", self._build_url(path, query_args))
+
+    def _post(self, path, query_args=None, files=None):
+        return self._request("POST", self._build_url(path, query_args), files=files)
+
+    def _post_json(self, path, payload):
+        return self._request("POST", self._build_url(path), json=payload)
+
+    def _request(self, method, url, files=None, **kwargs):
+        """
+        Makes the request, retrying with an exponential backoff on connection
+        errors, timeouts and the statuses in RETRY_STATUSES.
+
+        Retrying uploads is safe, as uploading the same image twice returns
+        the same id.
+        """
+        positions = {name: f.tell() for name, f in (files or {}).items()}
+        for attempt in range(self.retries + 1):
+            for name, position in positions.items():
+                files[name].seek(position)
+            try:
+                response = self.session.request(
+                    method, url, files=files, timeout=self.timeout, **kwargs
+                )
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        return response
+
+    def upload_many(self, paths):
+        """
+        Uploads the images at the given paths, with up to `concurrency` uploads
+        at a time. Returns a list with, for each path in order, either the
+        response or the exception that was raised.
+        """
+        return self._map(self.upload_from_file, paths)
+
+    def get_many(self, jobs):
+        """
+        Gets images with up to `concurrency` requests at a time. Each job is a
+        dict of the arguments to get_image. Returns a list with, for each job
+        in order, either the response or the exception that was raised.
+        """
+        return self._map(lambda job: self.get_image(**job), jobs)
+
+    def _map(self, function, items):
+        def call(item):
+            try:
+                return function(item)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(call, items))
+
+
+def read_batch(response):
+    """
+    Unpacks the response from get_images in to a list with, for each job in
+    order, either the image content or a BadRequest saying why it failed.
+    """
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
+        manifest = json.loads(zip_file.read("manifest.json"))
+        return [
+            zip_file.read(item["file"]) if "file" in item else BadRequest(item["error"])
+            for item in manifest
+        ]
+
 
 if __name__ == "__main__":
     api = ProgImageApi()
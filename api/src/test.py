@@ -1,7 +1,12 @@
+from io import BytesIO
+import json
 import tempfile
 from unittest import mock, TestCase
+import zipfile
 
-from api import BadRequest, ProgImageApi
+import requests
+
+from api import BadRequest, PooledProgImageApi, ProgImageApi, read_batch
 
 
 PATH = "/image"
@@ -117,3 +122,112 @@ class TestGetImage(TestApi):
         get_image_mock.assert_called_with(
             "/image", {"image_id": 1234, "rotate": 90, "filter": "blur"}
         )
+
+
+class TestGetImages(TestApi):
+    def test_bad_request(self):
+        with self.assertRaises(BadRequest):
+            self.api.get_images([{"image_id": 1234}, {"rotate": 90}])
+
+    @mock.patch("api.ProgImageApi._post_json")
+    def test_get_images(self, post_json_mock):
+        jobs = [{"image_id": 1234, **QUERY_ARGS}, {"url": "http://images.com/image"}]
+        self.api.get_images(jobs)
+        post_json_mock.assert_called_with("/batch", {"jobs": jobs})
+
+    @mock.patch("requests.post")
+    def test_post_json(self, post_mock):
+        self.api._post_json("/batch", {"jobs": []})
+        post_mock.assert_called_with("http://web:5000/batch", json={"jobs": []})
+
+
+class TestReadBatch(TestCase):
+    def test_read_batch(self):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as zip_file:
+            zip_file.writestr("1.png", b"image")
+            zip_file.writestr(
+                "manifest.json", json.dumps([{"error": "oops"}, {"file": "1.png"}])
+            )
+        error, image = read_batch(mock.MagicMock(content=buffer.getvalue()))
+        self.assertIsInstance(error, BadRequest)
+        self.assertEqual(str(error), "oops")
+        self.assertEqual(image, b"image")
+
+
+class TestPooledApi(TestCase):
+    def setUp(self):
+        self.api = PooledProgImageApi(concurrency=4, retries=2, backoff=0, timeout=5)
+        self.request_mock = mock.MagicMock()
+        self.request_mock.return_value.status_code = 200
+        self.api.session.request = self.request_mock
+
+    def test_get(self):
+        self.api._get(PATH, QUERY_ARGS)
+        self.request_mock.assert_called_with(
+            "GET",
+            "http://web:5000/image?rotate=90&filter=blur",
+            files=None,
+            timeout=5,
+        )
+
+    def test_post_json(self):
+        self.api._post_json("/batch", {"jobs": []})
+        self.request_mock.assert_called_with(
+            "POST", "http://web:5000/batch", files=None, timeout=5, json={"jobs": []}
+        )
+
+    def test_retries_on_status(self):
+        self.request_mock.side_effect = [
+            mock.MagicMock(status_code=503),
+            mock.MagicMock(status_code=200),
+        ]
+        response = self.api._get(PATH)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.request_mock.call_count, 2)
+
+    def test_gives_up_on_status(self):
+        self.request_mock.return_value.status_code = 503
+        response = self.api._get(PATH)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.request_mock.call_count, 3)
+
+    def test_retries_on_connection_error(self):
+        self.request_mock.side_effect = requests.ConnectionError
+        with self.assertRaises(requests.ConnectionError):
+            self.api._get(PATH)
+        self.assertEqual(self.request_mock.call_count, 3)
+
+    def test_retried_upload_is_rewound(self):
+        buffer = BytesIO(b"image")
+        contents = []
+
+        def request(method, url, files, **kwargs):
+            contents.append(files["file"].read())
+            return mock.MagicMock(status_code=503 if len(contents) == 1 else 200)
+
+        self.request_mock.side_effect = request
+        self.api.upload_from_buffer(buffer)
+        self.assertEqual(contents, [b"image", b"image"])
+
+    def test_upload_many(self):
+        paths = []
+        for content in [b"one", b"two"]:
+            handle, path = tempfile.mkstemp()
+            with open(handle, "wb") as f:
+                f.write(content)
+            paths.append(path)
+        self.request_mock.side_effect = lambda method, url, files, **kwargs: (
+            mock.MagicMock(status_code=200, content=files["file"].read())
+        )
+        responses = self.api.upload_many(paths + ["/foo"])
+        self.assertEqual([r.content for r in responses[:2]], [b"one", b"two"])
+        self.assertIsInstance(responses[2], FileNotFoundError)
+
+    def test_get_many(self):
+        responses = self.api.get_many([{"image_id": 1}, {"rotate": 90}])
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertIsInstance(responses[1], BadRequest)
+        self.request_mock.assert_called_once_with(
+            "GET", "http://web:5000/image?image_id=1", files=None, timeout=5
+        )
@@ -0,0 +1,301 @@
+"""
+Benchmarks the web service, offline, against synthetic images.
+
+Every scenario is run in a fresh process, so that its peak memory is its own,
+with the web service and the transformation services loaded in to it. With
+the remote backend the web service's requests to the transformation services
+are handed straight to their apps, so the cost of each hop is measured without
+the network.
+
+The results are printed as json, or written to --output, and compared with an
+earlier run with --baseline. For example
+
+$ python bench/bench.py --sizes small,medium --output before.json
+$ python bench/bench.py --sizes small,medium --baseline before.json
+"""
+import argparse
+import concurrent.futures
+import importlib
+import io
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from PIL import Image
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ["filter", "mask", "rotate", "thumbnail"]
+SIZES = {"small": (640, 480), "medium": (1920, 1080), "large": (4000, 3000)}
+FORMATS = ["JPEG", "PNG", "WEBP"]
+# The query args for each scenario, other than upload, which requests the
+# image in the format it was uploaded in.
+SCENARIOS = {
+    "upload": None,
+    "original": {},
+    "filter": {"filter": "blur"},
+    "mask": {"mask": "ellipse"},
+    "rotate": {"rotate": "90"},
+    "thumbnail": {"thumbnail": "200,200"},
+    "chain": {
+        "thumbnail": "800,800",
+        "filter": "blur",
+        "rotate": "45",
+        "mask": "ellipse",
+    },
+    # The chain again, served from the derived image cache after the warmup.
+    "cached": {
+        "thumbnail": "800,800",
+        "filter": "blur",
+        "rotate": "45",
+        "mask": "ellipse",
+    },
+}
+
+
+class ServiceAdapter(BaseAdapter):
+    """
+    Sends requests to a transformation service's app in process, rather than
+    over the network.
+    """
+
+    def __init__(self, app):
+        super().__init__()
+        self.client = app.test_client()
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        rv = self.client.open(
+            url.path,
+            method=request.method,
+            query_string=url.query,
+            data=request.body,
+            headers=dict(request.headers),
+        )
+        response = requests.Response()
+        response.status_code = rv.status_code
+        response.headers = CaseInsensitiveDict(rv.headers)
+        response._content = rv.data
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def load_app(name):
+    sys.path.insert(0, os.path.join(ROOT, name, "src"))
+    try:
+        return importlib.import_module(name).app
+    finally:
+        sys.path.pop(0)
+
+
+def load_web_app(backend, transport, cache):
+    progimage = importlib.import_module("progimage")
+    app = progimage.app
+    app.config.update(
+        IMAGES=tempfile.mkdtemp(),
+        TMP=tempfile.mkdtemp(),
+        TRANSFORM_BACKEND=backend,
+        TRANSFORM_TRANSPORT=transport,
+        # Renditions would be rendered in the background of the uploads.
+        RENDITION_PRESETS={},
+    )
+    if not cache:
+        app.config.update(DERIVED_CACHE_MEMORY_LIMIT=0, DERIVED_CACHE_DISK_LIMIT=0)
+    if backend == "remote":
+        for name in SERVICES:
+            session = progimage.get_transform_session(name)
+            endpoint = progimage.TRANSFORMATIONS[name]["endpoint"]
+            session.mount(endpoint.rsplit("/", 1)[0], ServiceAdapter(load_app(name)))
+    return app
+
+
+def make_image(size, file_format):
+    """
+    Draws the same image every time, with smooth areas and detail, so that it
+    compresses something like a photograph.
+    """
+    bands = [
+        Image.linear_gradient("L").resize(size),
+        Image.radial_gradient("L").resize(size),
+        Image.effect_mandelbrot(size, (-2, -1.5, 1, 1.5), 100),
+    ]
+    buffer = io.BytesIO()
+    Image.merge("RGB", bands).save(buffer, format=file_format)
+    return buffer.getvalue()
+
+
+def run_scenario(scenario, size, file_format, options):
+    sys.path.insert(0, os.path.join(ROOT, "common"))
+    sys.path.insert(0, os.path.join(ROOT, "progimage", "src"))
+    app = load_web_app(options.backend, options.transport, scenario == "cached")
+    data = make_image(SIZES[size], file_format)
+    client = app.test_client()
+    image_id = upload(client, data)
+    if scenario == "upload":
+        # Each upload is made unique, so it is stored rather than found to be a
+        # copy of an earlier one.
+        def send(index):
+            return upload(client, data + index.to_bytes(8, "big"))
+
+    else:
+        args = dict(SCENARIOS[scenario], image_id=image_id, format=file_format)
+        url = f"/image?{urllib.parse.urlencode(args)}"
+
+        def send(index):
+            rv = client.get(url)
+            if rv.status_code != 200:
+                raise RuntimeError(f"{url} returned {rv.status_code}")
+            return rv.data
+
+    for index in range(options.warmup):
+        send(index)
+    latencies = []
+
+    def timed_send(index):
+        start = time.perf_counter()
+        send(options.warmup + index)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(options.concurrency) as executor:
+        list(executor.map(timed_send, range(options.iterations)))
+    elapsed = time.perf_counter() - start
+    return {
+        "scenario": scenario,
+        "size": size,
+        "format": file_format,
+        "bytes": len(data),
+        "iterations": options.iterations,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "throughput_rps": options.iterations / elapsed,
+        "peak_rss_bytes": get_peak_rss(),
+    }
+
+
+def upload(client, data):
+    rv = client.post("/upload", data=data, content_type="application/octet-stream")
+    if rv.status_code != 200:
+        raise RuntimeError(f"/upload returned {rv.status_code}")
+    return rv.data.decode()
+
+
+def percentile(values, p):
+    """
+    The nearest rank percentile.
+    """
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_all(options):
+    results = []
+    for scenario in options.scenarios:
+        for size in options.sizes:
+            for file_format in options.formats:
+                print(f"{scenario} {size} {file_format}", file=sys.stderr)
+                command = [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--run",
+                    scenario,
+                    size,
+                    file_format,
+                ] + options.passed_on
+                output = subprocess.run(
+                    command, check=True, stdout=subprocess.PIPE
+                ).stdout
+                results.append(json.loads(output))
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "pillow": Image.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": options.backend,
+            "transport": options.transport,
+            "concurrency": options.concurrency,
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline):
+    """
+    Prints how the p50, p99 and throughput of each result changed from the
+    baseline, as a ratio, for example 0.8 when the time taken fell by a fifth.
+    """
+    before = {(r["scenario"], r["size"], r["format"]): r for r in baseline["results"]}
+    for result in report["results"]:
+        key = (result["scenario"], result["size"], result["format"])
+        if key not in before:
+            continue
+        changes = " ".join(
+            f"{metric}={result[metric] / before[key][metric]:.2f}"
+            for metric in ["p50_ms", "p99_ms", "throughput_rps"]
+        )
+        print(" ".join(key), changes, file=sys.stderr)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--sizes", default="small,medium")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--backend", choices=["local", "remote"], default="local")
+    parser.add_argument("--transport", choices=["multipart", "raw"], default="raw")
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--run", nargs=3, help=argparse.SUPPRESS)
+    options = parser.parse_args(argv)
+    for name in ["scenarios", "sizes", "formats"]:
+        setattr(options, name, getattr(options, name).split(","))
+    # The options that change how a scenario is run, for its process.
+    options.passed_on = [
+        f"--{name}={getattr(options, name)}"
+        for name in ["iterations", "warmup", "concurrency", "backend", "transport"]
+    ]
+    return options
+
+
+def main(argv):
+    options = parse_args(argv)
+    if options.run:
+        print(json.dumps(run_scenario(*options.run, options)))
+        return
+    report = run_all(options)
+    if options.baseline:
+        with open(options.baseline) as f:
+            compare(report, json.load(f))
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,33 @@
+# Settings for running the service under gunicorn in production, each of which
+# can be overridden with an environment variable.
+import multiprocessing
+import os
+import shutil
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+# Threaded workers let a worker take other requests while one waits on I/O.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 1))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+accesslog = "-"
+
+# Each worker keeps its own metrics, so they are written to files in a shared
+# directory for /metrics to add up. This must be set before the app is loaded.
+os.environ.setdefault("prometheus_multiproc_dir", "/tmp/metrics")
+
+
+def on_starting(server):
+    """
+    Clears out the metrics of any previous run.
+    """
+    path = os.environ["prometheus_multiproc_dir"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,98 @@
+"""
+Times each stage of handling a request, and counts the bytes that pass through
+them. The totals are exposed for Prometheus on /metrics, and the breakdown for
+each request is sent back in a Server-Timing header.
+
+Requests carry an X-Request-ID, which is made up if the client did not send
+one, so that a request can be followed from one service to the next.
+"""
+import contextlib
+import os
+import time
+import uuid
+
+from flask import g, has_request_context, request
+from prometheus_client import (
+    CollectorRegistry,
+    CONTENT_TYPE_LATEST,
+    Counter,
+    generate_latest,
+    Histogram,
+    multiprocess,
+    REGISTRY,
+)
+
+REQUEST_SECONDS = Histogram(
+    "request_seconds", "Time taken to handle a request", ["endpoint"]
+)
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time taken by each stage of handling a request", ["stage"]
+)
+STAGE_BYTES = Counter(
+    "stage_bytes", "Bytes read or written by each stage of a request", ["stage"]
+)
+
+
+def init_app(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule("/metrics", "metrics", get_metrics)
+
+
+def start_request():
+    g.request_id = request.headers.get("X-Request-ID") or str(uuid.uuid4())
+    g.timings = {}
+    g.start = time.perf_counter()
+    count_bytes("request", request.content_length or 0)
+
+
+def finish_request(response):
+    if "start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.start
+    REQUEST_SECONDS.labels(request.endpoint or "unknown").observe(elapsed)
+    if response.content_length:
+        count_bytes("response", response.content_length)
+    timings = dict(g.timings, total=elapsed)
+    response.headers["Server-Timing"] = ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Times the block as the stage. Stages that happen more than once in a
+    request are added together in its Server-Timing header.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        # background work, such as rendering renditions, has no request.
+        if has_request_context():
+            g.timings[stage] = g.timings.get(stage, 0) + elapsed
+
+
+def count_bytes(stage, size):
+    STAGE_BYTES.labels(stage).inc(size)
+
+
+def get_request_id():
+    return g.request_id if has_request_context() else None
+
+
+def get_metrics():
+    """
+    Under gunicorn each worker writes its metrics to files in a shared
+    directory, see gunicorn.conf.py, which are added up here.
+    """
+    registry = REGISTRY
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), 200, {"Content-Type": CONTENT_TYPE_LATEST}
@@ -0,0 +1,481 @@
+"""
+The filter, mask, rotate and thumbnail operations, which the transformation
+services apply, and the web service applies in process.
+
+A chain of steps is applied to a single decoded image, so that the image only
+needs to be encoded once, after the last step.
+
+Steps that can be are applied to large images a strip at a time, in place, so
+that peak memory depends on the size of a strip rather than holding a second
+full size copy of the image.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import math
+import os
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageOps
+
+import metrics
+
+# Formats that can not store an alpha channel, so a mask is composited on to a
+# white background instead.
+OPAQUE_FORMATS = {"JPEG"}
+WHITE = (255, 255, 255)
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations that turn the image on its side, swapping its width and
+# height.
+TRANSPOSING_ORIENTATIONS = {5, 6, 7, 8}
+
+# The number of pixels processed at a time when working on an image in strips.
+STRIP_PIXELS = 1 << 22
+# Images with more pixels than this are filtered in strips on a thread pool,
+# as Pillow releases the GIL while it filters.
+PARALLEL_PIXELS = 1 << 20
+# Masks for images with more pixels than this are not cached.
+MASK_CACHE_PIXELS = 1 << 20
+FILTER_WORKERS = os.cpu_count() or 1
+
+# Pillow's built in filters, which take no arguments.
+BUILTIN_FILTERS = [
+    "blur",
+    "contour",
+    "detail",
+    "edge_enhance",
+    "edge_enhance_more",
+    "emboss",
+    "find_edges",
+    "sharpen",
+    "smooth",
+    "smooth_more",
+]
+# Filters that take arguments, and how to parse each of them.
+PARAMETERISED_FILTERS = {
+    "gaussianblur": (ImageFilter.GaussianBlur, {"radius": float}),
+    "unsharpmask": (
+        ImageFilter.UnsharpMask,
+        {"radius": float, "percent": int, "threshold": int},
+    ),
+}
+
+
+def filter_image(im, effect, **params):
+    image_filter = get_filter(effect, **params)
+    margin = get_margin(image_filter)
+    pixels = im.width * im.height
+    workers = FILTER_WORKERS if pixels > PARALLEL_PIXELS else 1
+    if margin is None or (workers == 1 and pixels <= STRIP_PIXELS):
+        return im.filter(image_filter)
+    return filter_in_strips(im, image_filter, margin, workers)
+
+
+def get_filter(effect, **params):
+    """
+    Filters are looked up by name, and given any arguments they take from the
+    step.
+    """
+    if effect.lower() not in PARAMETERISED_FILTERS:
+        return getattr(ImageFilter, effect.upper())()
+    filter_class, arg_types = PARAMETERISED_FILTERS[effect.lower()]
+    return filter_class(
+        **{
+            name: arg_type(params[name])
+            for name, arg_type in arg_types.items()
+            if params.get(name) is not None
+        }
+    )
+
+
+def check_filter(effect, **params):
+    effect = str(effect).lower()
+    if effect not in BUILTIN_FILTERS and effect not in PARAMETERISED_FILTERS:
+        effects = BUILTIN_FILTERS + list(PARAMETERISED_FILTERS)
+        raise ValueError(f"filter must be one of {', '.join(effects)}.")
+    _, arg_types = PARAMETERISED_FILTERS.get(effect, (None, {}))
+    for name, arg_type in arg_types.items():
+        if params.get(name) is None:
+            continue
+        try:
+            value = arg_type(params[name])
+        except (TypeError, ValueError):
+            value = math.nan
+        if not 0 <= value < math.inf:
+            kind = "whole number" if arg_type is int else "number"
+            raise ValueError(f"{name} must be a {kind} of 0 or more.")
+
+
+def get_margin(image_filter):
+    """
+    How many rows either side of a pixel the filter reads, or None if that is
+    not known.
+    """
+    if hasattr(image_filter, "filterargs"):
+        return image_filter.filterargs[0][1] // 2
+    if hasattr(image_filter, "size"):
+        return image_filter.size // 2
+    if hasattr(image_filter, "radius"):
+        radius = image_filter.radius
+        if isinstance(radius, (tuple, list)):
+            radius = radius[1]
+        # Gaussian blurs are approximated by three box blurs, which between
+        # them reach about three times the radius.
+        return int(radius * 3) + 2
+    return None
+
+
+def filter_in_strips(im, image_filter, margin, workers=1):
+    """
+    Filters the image in place a strip at a time, or a batch of strips at a
+    time on the thread pool when there is more than one worker.
+
+    Each strip is filtered along with margin rows of the original image either
+    side of it, so the seams between strips match filtering the whole image at
+    once. The rows above the first strip of a batch have already been
+    overwritten by then, so the original rows are carried over from the batch
+    before.
+    """
+    rows = min(STRIP_PIXELS // im.width, -(-im.height // workers))
+    rows = max(rows, margin, 1)
+    tops = range(0, im.height, rows)
+    carry = None
+    for first in range(0, len(tops), workers):
+        batch = [(top, min(top + rows, im.height)) for top in tops[first:][:workers]]
+        sources = []
+        for top, bottom in batch:
+            end = min(bottom + margin, im.height)
+            if carry is not None and top == batch[0][0]:
+                source = Image.new(im.mode, (im.width, carry.height + end - top))
+                source.paste(carry, (0, 0))
+                source.paste(im.crop((0, top, im.width, end)), (0, carry.height))
+                sources.append((source, carry.height))
+            else:
+                start = max(top - margin, 0)
+                sources.append((im.crop((0, start, im.width, end)), top - start))
+        if margin:
+            last_bottom = batch[-1][1]
+            carry = im.crop((0, last_bottom - margin, im.width, last_bottom))
+        if workers == 1:
+            strips = [source.filter(image_filter) for source, _ in sources]
+        else:
+            strips = get_filter_executor().map(
+                lambda source: source[0].filter(image_filter), sources
+            )
+        for (top, bottom), (_, offset), strip in zip(batch, sources, strips):
+            strip = strip.crop((0, offset, im.width, offset + bottom - top))
+            im.paste(strip, (0, top))
+    return im
+
+
+@functools.lru_cache(maxsize=None)
+def get_filter_executor():
+    return ThreadPoolExecutor(FILTER_WORKERS)
+
+
+def mask_image(im, shape, feather="0", background=None):
+    """
+    Masks the image with the shape. When a background colour is given the
+    masked image is composited on to it, rather than kept as an alpha channel.
+    """
+    # Masks for large images are drawn each time rather than cached, so that
+    # the 64 cached masks take up no more than 64MB between them.
+    cached = im.width * im.height <= MASK_CACHE_PIXELS
+    if background is None:
+        make_mask = get_mask if cached else draw_mask
+        im.putalpha(make_mask(im.size, shape, float(feather)))
+        return im
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+    # Painting the background through the inverse of the mask composites the
+    # image on to it in place.
+    make_mask = get_inverse_mask if cached else draw_inverse_mask
+    im.paste(background, mask=make_mask(im.size, shape, float(feather)))
+    return im
+
+
+@functools.lru_cache(maxsize=32)
+def get_mask(size, shape, feather=0.0):
+    """
+    Masks are cached, as most images come in a handful of sizes. They are
+    shared between requests, so must not be modified.
+    """
+    return draw_mask(size, shape, feather)
+
+
+@functools.lru_cache(maxsize=32)
+def get_inverse_mask(size, shape, feather=0.0):
+    return ImageChops.invert(get_mask(size, shape, feather))
+
+
+def draw_mask(size, shape, feather=0.0):
+    width, height = size
+    mask = Image.new("L", size, color=10)
+    draw = ImageDraw.Draw(mask)
+    transparent_area = (width / 10, height / 10, width / 10 * 9, height / 10 * 9)
+    shape_function = getattr(draw, shape)
+    shape_function(transparent_area, fill=255)
+    if feather:
+        # Blurring a cached mask softens its edges for free on later requests.
+        mask = mask.filter(ImageFilter.GaussianBlur(feather))
+    return mask
+
+
+def draw_inverse_mask(size, shape, feather=0.0):
+    return ImageChops.invert(draw_mask(size, shape, feather))
+
+
+def flatten(im, background=WHITE):
+    """
+    Composites an image with an alpha channel on to a background, a strip at a
+    time, for saving in formats without transparency.
+    """
+    # Modes such as CMYK have no alpha channel, only colours the format can not
+    # store.
+    if "A" not in im.getbands():
+        return im.convert("RGB")
+    flat = Image.new("RGB", im.size, background)
+    rows = max(STRIP_PIXELS // im.width, 1)
+    for top in range(0, im.height, rows):
+        box = (0, top, im.width, min(top + rows, im.height))
+        strip = im.crop(box)
+        flat.paste(strip, box, mask=strip.getchannel("A"))
+    return flat
+
+
+TRANSPOSES = {90: Image.ROTATE_90, 180: Image.ROTATE_180, 270: Image.ROTATE_270}
+RESAMPLE = {
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC,
+}
+
+
+def rotate_image(im, degrees, expand="false", resample="nearest"):
+    """
+    Rotates the image anticlockwise. When the canvas grows to fit the rotated
+    image, or the rotation keeps it the same shape, right angles only need to
+    move pixels around rather than resample the image.
+    """
+    degrees = float(degrees) % 360
+    expand = parse_bool(expand)
+    if degrees == 0:
+        return im
+    if degrees in TRANSPOSES and (expand or degrees == 180 or im.width == im.height):
+        return im.transpose(TRANSPOSES[degrees])
+    return im.rotate(degrees, resample=RESAMPLE[resample.lower()], expand=expand)
+
+
+def check_rotate(degrees, expand="false", resample="nearest"):
+    try:
+        degrees = float(degrees)
+    except (TypeError, ValueError):
+        degrees = math.nan
+    if not math.isfinite(degrees):
+        raise ValueError("rotate must be a number of degrees, such as 90.")
+    if str(resample).lower() not in RESAMPLE:
+        raise ValueError(f"resample must be one of {', '.join(RESAMPLE)}.")
+
+
+def orient(im):
+    """
+    Cameras record which way up they were held in the EXIF Orientation tag,
+    rather than rotating the pixels, so images are turned the right way up
+    before anything else is done to them.
+    """
+    if get_orientation(im) == 1:
+        return im
+    return ImageOps.exif_transpose(im)
+
+
+def get_orientation(im):
+    return im.getexif().get(EXIF_ORIENTATION, 1)
+
+
+def get_oriented_size(size, orientation):
+    """
+    The size of an image once it has been turned the right way up, or of the
+    stored image for a size the right way up.
+    """
+    width, height = size
+    if orientation in TRANSPOSING_ORIENTATIONS:
+        return height, width
+    return size
+
+
+def parse_bool(value):
+    return str(value).lower() in {"1", "true", "yes", "on"}
+
+
+THUMBNAIL_MODES = ["fit", "fill", "crop"]
+# Resizing can also use the filters that rotating can not.
+RESIZE_RESAMPLE = dict(
+    RESAMPLE, box=Image.BOX, hamming=Image.HAMMING, lanczos=Image.LANCZOS
+)
+
+
+def thumbnail_image(im, size, mode="fit", resample="bicubic", reducing_gap="2"):
+    """
+    Shrinks the image to fit inside the size, keeping its aspect ratio. The
+    fill mode then pads it to exactly the size, and the crop mode instead
+    covers the size and crops away what is left over, both about the centre.
+
+    The image is first shrunk by a whole factor with Image.reduce, which is
+    much faster, until it is within reducing_gap times the size, and only then
+    resampled. Smaller gaps, down to 1, are faster, and a gap of 0 resamples
+    the whole way.
+    """
+    if mode not in THUMBNAIL_MODES:
+        raise ValueError(f"Unknown thumbnail mode {mode}")
+    size = parse_size(size)
+    resample = RESIZE_RESAMPLE[resample.lower()]
+    reducing_gap = float(reducing_gap) or None
+    if mode == "crop":
+        return crop_to(im, size, resample, reducing_gap)
+    im.thumbnail(size, resample, reducing_gap=reducing_gap)
+    if mode == "fill":
+        return pad_to(im, size)
+    return im
+
+
+def check_thumbnail(size, mode="fit", resample="bicubic", reducing_gap="2"):
+    if mode not in THUMBNAIL_MODES:
+        raise ValueError(f"mode must be one of {', '.join(THUMBNAIL_MODES)}.")
+    try:
+        width, height = parse_size(str(size))
+    except ValueError:
+        width = height = 0
+    if width < 1 or height < 1:
+        raise ValueError("thumbnail must be a width and height, such as 200,200.")
+    if str(resample).lower() not in RESIZE_RESAMPLE:
+        raise ValueError(f"resample must be one of {', '.join(RESIZE_RESAMPLE)}.")
+    try:
+        reducing_gap = float(reducing_gap)
+    except (TypeError, ValueError):
+        reducing_gap = math.nan
+    # Pillow takes gaps of 1 or more, and 0 turns the reduction off.
+    if not (reducing_gap == 0 or 1 <= reducing_gap < math.inf):
+        raise ValueError("reducing_gap must be 0, or a number of 1 or more.")
+
+
+def crop_to(im, size, resample, reducing_gap):
+    width, height = size
+    scale = max(width / im.width, height / im.height)
+    crop_width, crop_height = width / scale, height / scale
+    left = (im.width - crop_width) / 2
+    top = (im.height - crop_height) / 2
+    box = (left, top, left + crop_width, top + crop_height)
+    return im.resize(size, resample, box=box, reducing_gap=reducing_gap)
+
+
+def pad_to(im, size):
+    """
+    Pads the image with white, or transparency if it has an alpha channel.
+    """
+    if im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+    canvas = Image.new(im.mode, size, (255, 255, 255, 0)[: len(im.mode)])
+    canvas.paste(im, ((size[0] - im.width) // 2, (size[1] - im.height) // 2))
+    return canvas
+
+
+def parse_size(size):
+    return tuple(int(part) for part in size.split(","))
+
+
+OPERATIONS = {
+    "filter": filter_image,
+    "mask": mask_image,
+    "rotate": rotate_image,
+    "thumbnail": thumbnail_image,
+}
+# Checks that the arguments of an operation can be parsed, so that a request
+# with bad ones is turned away before any work is done on it.
+CHECKS = {
+    "filter": check_filter,
+    "rotate": check_rotate,
+    "thumbnail": check_thumbnail,
+}
+
+
+def check_step(step):
+    """
+    Raises ValueError, with a message for the client, if the step's arguments
+    are not valid.
+    """
+    params = {key: value for key, value in step.items() if key != "op"}
+    if step["op"] in CHECKS:
+        CHECKS[step["op"]](**params)
+
+
+# Operations that give the same result whether they are applied before or after
+# the image is shrunk to fit a thumbnail. The masks are proportional to the image
+# size, and a rotation keeps the canvas size unless it is expanded. Filters are
+# not, as their kernels and radii are a number of pixels, which covers more of
+# the picture once it has been shrunk.
+SCALE_INDEPENDENT = {"mask", "rotate"}
+
+
+def is_movable_thumbnail(step):
+    """
+    Only shrinking to fit gives the same image whether the steps it moves
+    ahead of are applied before or after it. Padding and cropping would change
+    what the other steps see.
+    """
+    return step["op"] == "thumbnail" and step.get("mode", "fit") == "fit"
+
+
+def is_scale_independent(step):
+    if step["op"] == "rotate" and parse_bool(step.get("expand")):
+        return False
+    return step["op"] in SCALE_INDEPENDENT
+
+
+def plan(steps):
+    """
+    Reorder the steps so that thumbnails are applied as early as it is safe to
+    do so, leaving the other steps fewer pixels to work on.
+    """
+    planned = []
+    for step in steps:
+        position = len(planned)
+        if is_movable_thumbnail(step):
+            while position and is_scale_independent(planned[position - 1]):
+                position -= 1
+        planned.insert(position, step)
+    return planned
+
+
+def draft(im, steps):
+    """
+    When a JPEG is going to be shrunk straight away, have the decoder scale it
+    down while decoding, so that the full size image is never decoded.
+
+    This must be called before the image is loaded.
+    """
+    if steps and steps[0]["op"] == "thumbnail" and im.format == "JPEG":
+        # The image is decoded before it is oriented, so the size is turned to
+        # match the way the image is stored.
+        size = parse_size(steps[0]["size"])
+        im.draft(im.mode, get_oriented_size(size, get_orientation(im)))
+
+
+def run(im, steps, file_format=None):
+    """
+    Applies each step to the image in order, returning the final image.
+
+    A step is a dict with the name of the operation under "op", and the
+    arguments for that operation under the same names the services use.
+
+    When the image will be saved in a format without transparency, a mask in
+    the last step is composited straight on to a white background, rather
+    than being added as an alpha channel only to be flattened when it is saved.
+    """
+    opaque = file_format is not None and file_format.upper() in OPAQUE_FORMATS
+    for index, step in enumerate(steps):
+        params = {key: value for key, value in step.items() if key != "op"}
+        last = index == len(steps) - 1
+        if step["op"] == "mask" and last and opaque:
+            params["background"] = WHITE
+        with metrics.timed(step["op"]):
+            im = OPERATIONS[step["op"]](im, **params)
+    return im
@@ -0,0 +1,121 @@
+"""
+What the filter, mask, rotate and thumbnail services share: reading the posted
+image and the ops to apply to it, applying them with the pipeline, and sending
+the image back.
+"""
+import io
+import json
+
+from flask import abort, current_app, redirect, request, send_file
+from PIL import Image
+
+import metrics
+import pipeline
+
+
+def transform(name, ops, orient=False):
+    """
+    Applies the ops, each the arguments of one of the named operation, to the
+    posted image, and sends it back in its own format.
+    """
+    steps = [dict(op, op=name) for op in ops]
+    for step in steps:
+        try:
+            pipeline.check_step(step)
+        except ValueError as error:
+            abort(400, str(error))
+    file = get_file()
+    if file is None:
+        return redirect(request.url)
+    with Image.open(file, formats=get_formats()) as im:
+        check_size(im)
+        save_args = get_save_args(im.format)
+        file_format = save_args["format"]
+        with metrics.timed("decode"):
+            im.load()
+        if orient:
+            with metrics.timed("orient"):
+                im = pipeline.orient(im)
+        im = pipeline.run(im, steps, file_format)
+        with metrics.timed("encode"):
+            buffer = save(im, **save_args)
+        metrics.count_bytes("encode", buffer.getbuffer().nbytes)
+    return send_file(buffer, mimetype=f"image/{file_format}")
+
+
+def get_file():
+    """
+    The image can be sent as the raw request body, optionally with its format
+    in the X-Image-Format header, or as a multipart form under 'file'.
+    """
+    if request.mimetype == "application/octet-stream":
+        return io.BytesIO(request.get_data())
+    if "file" not in request.files:
+        print("No file part")
+        return None
+    file = request.files["file"]
+    if file.filename == "":
+        print("No selected file")
+        return None
+    return file
+
+
+def get_formats():
+    """
+    When we are told the format, Pillow can skip trying every other format.
+    """
+    file_format = request.headers.get("X-Image-Format")
+    return [file_format.upper()] if file_format else None
+
+
+def check_size(im):
+    """
+    Opening an image only reads its header, so this happens before the image
+    is decoded.
+    """
+    check_pixels(im.width, im.height)
+
+
+def check_pixels(width, height):
+    max_pixels = current_app.config["MAX_IMAGE_PIXELS"]
+    if width * height > max_pixels:
+        abort(413, f"Images must have no more than {max_pixels} pixels")
+
+
+def get_ops(name):
+    """
+    Reads the json list of operations from the ops query arg, returning the
+    arguments for each one.
+    """
+    try:
+        ops = json.loads(request.args.get("ops", ""))
+    except ValueError:
+        ops = None
+    if not isinstance(ops, list) or not all(
+        isinstance(op, dict) and op.get("op", name) == name for op in ops
+    ):
+        abort(400, f"ops must be a json list of {name} operations")
+    return [{key: value for key, value in op.items() if key != "op"} for op in ops]
+
+
+def get_save_args(file_format):
+    """
+    Between the steps of a chain the web service asks for a fast, lossless
+    PNG, so that the image is only encoded in its final format once.
+    """
+    if request.headers.get("X-Intermediate"):
+        return {"format": "PNG", "compress_level": 1}
+    return {"format": file_format}
+
+
+def save(im, **save_args):
+    buffer = io.BytesIO()
+    try:
+        im.save(buffer, **save_args)
+    except OSError:
+        # Trick for converting rgba type formats to jpeg.
+
+        # credit: https://stackoverflow.com/a/9459208/2610613
+        pipeline.flatten(im).save(buffer, **save_args)
+    buffer.seek(0)
+    return buffer
@@ -1,9 +1,13 @@
-import io
+from flask import Flask, request
+from PIL import Image
 
-from flask import Flask, request, redirect, send_file
-from PIL import Image, ImageFilter
+import metrics
+import service
 
 app = Flask(__name__)
+metrics.init_app(app)
+# Images with more pixels than this are rejected before they are decoded.
+app.config["MAX_IMAGE_PIXELS"] = 50 * 1000 * 1000
 
 
 @app.route("/")
@@ -11,22 +15,29 @@ def hello_world():
     return "Hello, filter!"
 
 
+@app.errorhandler(Image.DecompressionBombError)
+def decompression_bomb(error):
+    return str(error), 413
+
+
 @app.route("/filter", methods=["POST"])
 def filter():
-    effect = request.args.get("effect")
-    if "file" not in request.files:
-        print("No file part")
-        return redirect(request.url)
-    file = request.files["file"]
-    if file.filename == "":
-        print("No selected file")
-        return redirect(request.url)
-    f = io.BytesIO()
-    file_format = None
-
-    filter_class = getattr(ImageFilter, effect.upper())
-    with Image.open(file) as im:
-        file_format = im.format
-        im.filter(filter_class).save(f, format=file_format)
-        f.seek(0)
-    return send_file(f, mimetype=f"image/{file_format}")
+    """
+    Applies the effect, with the radius, percent and threshold of the filters
+    that take them.
+    """
+    op = {"effect": request.args.get("effect")}
+    for name in ["radius", "percent", "threshold"]:
+        if request.args.get(name):
+            op[name] = request.args.get(name)
+    return service.transform("filter", [op])
+
+
+@app.route("/ops", methods=["POST"])
+def ops():
+    """
+    Applies several filters in one request. The ops query arg is a json list
+    of them in the order they are applied, for example
+    [{"op": "filter", "effect": "blur"}, {"op": "filter", "effect": "sharpen"}]
+    """
+    return service.transform("filter", service.get_ops("filter"))
@@ -1,9 +1,13 @@
-import io
+from flask import Flask, request
+from PIL import Image
 
-from flask import Flask, request, redirect, send_file
-from PIL import Image, ImageDraw
+import metrics
+import service
 
 app = Flask(__name__)
+metrics.init_app(app)
+# Images with more pixels than this are rejected before they are decoded.
+app.config["MAX_IMAGE_PIXELS"] = 50 * 1000 * 1000
 
 
 @app.route("/")
@@ -11,54 +15,28 @@ def hello_world():
     return "Hello, mask!"
 
 
+@app.errorhandler(Image.DecompressionBombError)
+def decompression_bomb(error):
+    return str(error), 413
+
+
 @app.route("/mask", methods=["POST"])
 def mask():
     """
-    Can be used to add a black mask with the specified shape to the image
+    Can be used to add a black mask with the specified shape to the image,
+    with its edges softened by the feather radius, if one is given.
     """
-    shape = request.args.get("shape")
-    if "file" not in request.files:
-        print("No file part")
-        return redirect(request.url)
-    file = request.files["file"]
-    if file.filename == "":
-        print("No selected file")
-        return redirect(request.url)
-
-    file_format = None
-
-    with Image.open(file) as im:
-        file_format = im.format
-        mask = get_mask(im, shape)
-        im.putalpha(mask)
-        buffer = save(im, file_format)
-    return send_file(buffer, mimetype=f"image/{file_format}")
-
+    op = {"shape": request.args.get("shape")}
+    if request.args.get("feather"):
+        op["feather"] = request.args.get("feather")
+    return service.transform("mask", [op])
 
-def save(im, file_format):
-    buffer = io.BytesIO()
-    try:
-        im.save(buffer, format=file_format)
-    except OSError:
-        # Trick for converting rgba type formats to jpeg.
 
-        # credit: https://stackoverflow.com/a/9459208/2610613
-        rgb = Image.new("RGB", im.size, (255, 255, 255))
-        rgb.paste(im, mask=im.split()[3])
-        rgb.save(buffer, format=file_format)
-    buffer.seek(0)
-    return buffer
-
-
-def get_mask(im, shape):
-    mask = Image.new("L", im.size, color=10)
-    draw = ImageDraw.Draw(mask)
-    transparent_area = (
-        im.width / 10,
-        im.height / 10,
-        im.width / 10 * 9,
-        im.height / 10 * 9,
-    )
-    shape_function = getattr(draw, shape)
-    shape_function(transparent_area, fill=255)
-    return mask
+@app.route("/ops", methods=["POST"])
+def ops():
+    """
+    Applies several masks in one request. The ops query arg is a json list of
+    them in the order they are applied, for example
+    [{"op": "mask", "shape": "ellipse"}, {"op": "mask", "shape": "rectangle"}]
+    """
+    return service.transform("mask", service.get_ops("mask"))
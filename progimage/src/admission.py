@@ -0,0 +1,125 @@
+"""
+Decides whether an image is cheap enough to render, from its dimensions alone,
+before any of it is decoded.
+
+The cost of a request is estimated as the number of times a pixel is read or
+written, summed over decoding the image and each of the steps. Steps read
+their input and write their output, which for padded or cropped thumbnails and
+expanded rotations can be larger than the image.
+"""
+
+import math
+
+from PIL import Image, ImageFilter
+
+from errors import InvalidUsage
+import pipeline
+
+# Roughly how many times an operation touches each pixel it is given, for the
+# operations whose cost does not depend on their arguments.
+COSTS = {"mask": 2, "rotate": 2, "thumbnail": 1}
+# For filters without a fixed size kernel, such as blurs made of box blurs.
+DEFAULT_FILTER_COST = 9
+
+
+def read_header(path):
+    """
+    Returns the size of the image once it has been turned the right way up, and
+    its format, reading only its header.
+    """
+    try:
+        with Image.open(path) as im:
+            size = pipeline.get_oriented_size(im.size, pipeline.get_orientation(im))
+            return size, im.format
+    except Image.DecompressionBombError:
+        raise too_large()
+
+
+def check_pixels(size, max_pixels):
+    width, height = size
+    if width * height > max_pixels:
+        raise too_large()
+
+
+def check(size, file_format, steps, max_pixels, budget):
+    """
+    Rejects images with more than max_pixels, steps that would make an image
+    with more than max_pixels, and steps estimated to cost more than the budget.
+
+    The size is that of the image once it has been turned the right way up, as
+    the steps see it.
+    """
+    check_pixels(size, max_pixels)
+    output_size = size
+    for step in steps:
+        output_size = get_output_size(output_size, step)
+        check_pixels(output_size, max_pixels)
+    if estimate(size, file_format, steps) > budget:
+        raise InvalidUsage(
+            "The requested transformations are too expensive for an image of "
+            "this size.",
+            status_code=413,
+        )
+
+
+def estimate(size, file_format, steps):
+    width, height = get_decoded_size(size, file_format, steps)
+    cost = width * height
+    for step in steps:
+        output_width, output_height = get_output_size((width, height), step)
+        cost += width * height * get_cost(step) + output_width * output_height
+        width, height = output_width, output_height
+    return cost
+
+
+def get_output_size(size, step):
+    width, height = size
+    if step["op"] == "thumbnail":
+        target_width, target_height = pipeline.parse_size(step["size"])
+        if step.get("mode", "fit") != "fit":
+            # padded or cropped to exactly the size.
+            return target_width, target_height
+        scale = min(1, target_width / width, target_height / height)
+        return max(1, int(width * scale)), max(1, int(height * scale))
+    if step["op"] == "rotate" and pipeline.parse_bool(step.get("expand")):
+        angle = math.radians(float(step["degrees"]))
+        cos, sin = abs(math.cos(angle)), abs(math.sin(angle))
+        # rounded first, so that right angles do not gain a pixel.
+        return (
+            math.ceil(round(width * cos + height * sin, 6)),
+            math.ceil(round(width * sin + height * cos, 6)),
+        )
+    return size
+
+
+def get_decoded_size(size, file_format, steps):
+    """
+    JPEGs that are shrunk straight away are decoded at up to an eighth of their
+    size, see pipeline.draft.
+    """
+    width, height = size
+    if not steps or steps[0]["op"] != "thumbnail" or file_format != "JPEG":
+        return size
+    target_width, target_height = pipeline.parse_size(steps[0]["size"])
+    scale = 1
+    while (
+        scale < 8
+        and width // (scale * 2) >= target_width
+        and height // (scale * 2) >= target_height
+    ):
+        scale *= 2
+    return width // scale, height // scale
+
+
+def get_cost(step):
+    if step["op"] != "filter":
+        return COSTS[step["op"]]
+    image_filter = getattr(ImageFilter, step["effect"].upper(), None)
+    if hasattr(image_filter, "filterargs"):
+        width, height = image_filter.filterargs[0]
+        return width * height
+    return DEFAULT_FILTER_COST
+
+
+def too_large():
+    return InvalidUsage("The image has too many pixels.", status_code=413)
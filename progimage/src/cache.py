@@ -0,0 +1,162 @@
+"""
+A cache of rendered images, keyed by the source image and the normalised
+arguments it was rendered with.
+
+Entries are kept in a small in memory tier for the hottest variants, backed by
+a larger tier on disk that is shared by every worker on the host. Both tiers
+evict the least recently used entries once they hold more than their limit in
+bytes.
+"""
+import collections
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# The file the size of a shared directory is counted in, which starts with a
+# "." so that it is never taken for an entry.
+SIZE_NAME = ".size"
+
+
+def cache_key(source, render_args):
+    """
+    Build a key from the identity of the source image and a json serialisable
+    description of how it is rendered.
+    """
+    canonical = json.dumps([source, render_args], sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def entries_on_disk(directory):
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.startswith("."):
+                # still being written.
+                continue
+            path = os.path.join(root, name)
+            try:
+                yield path, os.stat(path)
+            except FileNotFoundError:
+                # evicted by another worker.
+                pass
+
+
+def evict_from_disk(directory, limit):
+    """
+    Remove the least recently modified files in the directory until it is
+    back under 90% of the limit, so that eviction does not run on every write.
+    Returns the size of the files that are left.
+    """
+    entries = sorted(entries_on_disk(directory), key=lambda entry: entry[1].st_mtime)
+    size = sum(stat.st_size for _, stat in entries)
+    for path, stat in entries:
+        if size <= limit * 0.9:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= stat.st_size
+    return size
+
+
+class DiskUsage:
+    """
+    Counts the bytes written to a directory that every worker on the host
+    writes to, in a file alongside them, so that the writes of every worker
+    count towards the limit rather than only this one's.
+    """
+
+    def __init__(self, directory, limit):
+        self.directory = directory
+        self.limit = limit
+
+    def add(self, size):
+        """
+        Counts a file of size bytes that has just been written, evicting the
+        least recently used files once the directory holds more than the limit.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, SIZE_NAME), "a+") as f:
+            # Held until the file is closed, after the new total is written.
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                total = int(f.read()) + size
+            except ValueError:
+                # Nothing has been counted yet, so count what is already there,
+                # which includes the new file.
+                total = sum(stat.st_size for _, stat in entries_on_disk(self.directory))
+            if total > self.limit:
+                total = evict_from_disk(self.directory, self.limit)
+            f.truncate(0)
+            f.write(str(total))
+
+
+class DerivedCache:
+    def __init__(self, directory, memory_limit, disk_limit):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._memory = collections.OrderedDict()
+        self._memory_size = 0
+        self._disk_usage = DiskUsage(directory, disk_limit)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns a tuple of the rendered bytes and their format, or None if the
+        key is not cached.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                return entry
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                file_format = f.readline().decode().strip()
+                data = f.read()
+            # The modification time is used to find the least recently used
+            # entries on disk.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._remember(key, data, file_format)
+        return data, file_format
+
+    def put(self, key, data, file_format):
+        self._remember(key, data, file_format)
+        if len(data) > self.disk_limit:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file and rename it, so that other workers never
+        # read a partially written entry.
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(handle, "wb") as f:
+            f.write(f"{file_format}\n".encode())
+            f.write(data)
+            size = f.tell()
+        os.replace(tmp_path, path)
+        self._disk_usage.add(size)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _remember(self, key, data, file_format):
+        if len(data) > self.memory_limit:
+            return
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = (data, file_format)
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_limit:
+                _, (evicted, _) = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
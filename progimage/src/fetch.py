@@ -0,0 +1,135 @@
+"""
+Downloads images from urls, keeping a copy of each on disk so that popular urls
+are only downloaded once, and are then revalidated with the origin using their
+ETag or Last-Modified headers once they have gone stale.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import DiskUsage
+from errors import InvalidUsage
+
+CHUNK_SIZE = 64 * 1024
+
+
+class RemoteFetcher:
+    def __init__(
+        self, directory, max_bytes, disk_limit, max_age, timeout, pool_size=10
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.disk_limit = disk_limit
+        self.max_age = max_age
+        self.timeout = timeout
+        self._disk_usage = DiskUsage(directory, disk_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, url):
+        """
+        Returns the path to a local copy of the image at the url. The copy is
+        named by the sha256 of its content.
+        """
+        meta_path = os.path.join(
+            self.directory, "urls", hashlib.sha256(url.encode()).hexdigest()
+        )
+        meta = self._read_meta(meta_path)
+        if meta and time.time() - meta["fetched_at"] < self.max_age:
+            os.utime(self._body_path(meta["sha256"]))
+            return self._body_path(meta["sha256"])
+
+        headers = {}
+        if meta and meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta["last_modified"]:
+            headers["If-Modified-Since"] = meta["last_modified"]
+        response = self.session.get(
+            url, headers=headers, stream=True, timeout=self.timeout
+        )
+        try:
+            if meta and response.status_code == 304:
+                os.utime(self._body_path(meta["sha256"]))
+            elif response.status_code >= 400:
+                raise InvalidUsage(
+                    f"Fetching the url failed with status {response.status_code}"
+                )
+            else:
+                meta = {
+                    "sha256": self._download(response),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+        finally:
+            response.close()
+
+        meta["fetched_at"] = time.time()
+        self._write(meta_path, json.dumps(meta).encode())
+        return self._body_path(meta["sha256"])
+
+    def _body_path(self, sha256):
+        return os.path.join(self.directory, "bodies", sha256)
+
+    def _read_meta(self, meta_path):
+        """
+        Returns what we know about a previous fetch of the url, provided the
+        copy of the image has not been evicted since.
+        """
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if not os.path.exists(self._body_path(meta["sha256"])):
+            return None
+        return meta
+
+    def _download(self, response):
+        """
+        Streams the response body to disk, returning the sha256 of its content.
+        """
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > self.max_bytes:
+            raise self._too_large()
+
+        os.makedirs(os.path.join(self.directory, "bodies"), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(
+            dir=os.path.join(self.directory, "bodies"), prefix="."
+        )
+        sha256 = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(handle, "wb") as f:
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise self._too_large()
+                    sha256.update(chunk)
+                    f.write(chunk)
+            os.replace(tmp_path, self._body_path(sha256.hexdigest()))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self._disk_usage.add(size)
+        return sha256.hexdigest()
+
+    def _too_large(self):
+        return InvalidUsage(
+            f"The image at the url is larger than {self.max_bytes} bytes",
+            status_code=413,
+        )
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
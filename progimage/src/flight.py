@@ -0,0 +1,109 @@
+"""
+Collapses identical renders that are in flight at the same time in to one, so
+that a burst of requests for a new image renders it once rather than once for
+every request.
+
+Within a worker, the first thread to ask for a key does the work, and the rest
+wait for its result. Across the workers on a host, the first to take the lock
+file for a key does the work, and the rest wait for the lock, up to a timeout,
+before looking for the result somewhere they share, such as the derived cache
+on disk.
+"""
+import contextlib
+import fcntl
+import os
+import threading
+import time
+
+# How often in seconds a worker waiting for a host lock tries to take it.
+POLL_INTERVAL = 0.05
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, directory, timeout=30):
+        self.directory = directory
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, work):
+        """
+        Returns the result of calling work, unless another thread in this worker
+        is already doing so for the key, in which case it waits for and returns
+        that thread's result, or raises its error. The result is shared, so it
+        should not be changed.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = work()
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    @contextlib.contextmanager
+    def host_lock(self, key):
+        """
+        Holds an exclusive lock on the key across every worker on the host.
+
+        The lock is released if its worker dies, but a threaded worker is kept
+        alive by its heartbeat while a request thread is stuck, so a worker
+        waits no more than timeout seconds for the lock before going ahead
+        without it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+        f = self._lock_file(path, time.monotonic() + self.timeout)
+        try:
+            yield
+        finally:
+            if f is not None:
+                os.remove(path)
+                # Closing the file releases the lock.
+                f.close()
+
+    def _lock_file(self, path, deadline):
+        """
+        Returns the locked file at the path, or None if it could not be locked
+        by the deadline.
+        """
+        while True:
+            f = open(path, "a")
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        f.close()
+                        return None
+                    time.sleep(POLL_INTERVAL)
+            # The holder before us removes the file as it lets go, so if we
+            # locked a file that has since been removed, or replaced, another
+            # worker can lock the new one at the same time. Try again.
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
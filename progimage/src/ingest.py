@@ -0,0 +1,77 @@
+"""
+Streams uploaded images to disk in chunks rather than holding them in memory,
+before adding them to the image store.
+"""
+import hashlib
+import os
+import tempfile
+import uuid
+
+from PIL import Image, UnidentifiedImageError
+
+from errors import BadPayload, InvalidUsage
+
+CHUNK_SIZE = 64 * 1024
+
+
+def store(stream, image_store, max_bytes, max_pixels):
+    """
+    Writes the stream to a temporary file while hashing it, checks that it is
+    an image of no more than max_pixels, and then adds it to the store. Returns
+    the id of the image.
+
+    If an identical image has already been uploaded, its id is returned instead
+    of storing another copy.
+    """
+    # Writing the temporary file in to the store's directory means it can be
+    # renamed in to place atomically, so a partially uploaded image is never
+    # visible under its id.
+    handle, tmp_path = tempfile.mkstemp(dir=image_store.directory, prefix=".")
+    try:
+        with os.fdopen(handle, "wb") as f:
+            sha256 = copy_stream(stream, f, max_bytes)
+        if not os.path.getsize(tmp_path):
+            raise BadPayload("There was no uploaded file")
+        check_is_image(tmp_path, max_pixels)
+        return image_store.add(str(uuid.uuid4()), tmp_path, sha256)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def copy_stream(stream, f, max_bytes):
+    """
+    Copies the stream to the file in chunks, returning the sha256 of the
+    content.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return sha256.hexdigest()
+        size += len(chunk)
+        if size > max_bytes:
+            raise InvalidUsage(
+                f"Uploads must be smaller than {max_bytes} bytes", status_code=413
+            )
+        sha256.update(chunk)
+        f.write(chunk)
+
+
+def check_is_image(path, max_pixels):
+    """
+    Opening an image only reads its header, so this is cheap even for large
+    images.
+    """
+    try:
+        with Image.open(path) as im:
+            size = im.size
+    except UnidentifiedImageError:
+        raise BadPayload("The uploaded file is not an image")
+    except Image.DecompressionBombError:
+        size = None
+    if size is None or size[0] * size[1] > max_pixels:
+        raise InvalidUsage(
+            f"Uploads must have no more than {max_pixels} pixels", status_code=413
+        )
@@ -1,44 +1,150 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import contextlib
+import datetime
+import functools
 import io
+import itertools
+import json
 import os
+import types
 import urllib.parse
-import uuid
+import zipfile
 
-from flask import Flask, request, send_file
+from flask import abort, Flask, jsonify, request, send_file
 from PIL import Image
 import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.http import is_resource_modified
+
+import admission
+from cache import cache_key, DerivedCache
+from errors import BadPayload, InvalidUsage
+from fetch import RemoteFetcher
+from flight import SingleFlight
+import ingest
+import metrics
+import pipeline
+from store import ImageStore
+from stream import EncodeStream, STREAMABLE_FORMATS
 
 app = Flask(__name__)
 app.config["IMAGES"] = "/images"
 app.config["TMP"] = "/tmp"
-
-
-TRANSFORMATIONS = {
-    "filter": {"endpoint": "http://filter:5003/filter", "query_arg": "effect"},
-    "mask": {"endpoint": "http://mask:5004/mask", "query_arg": "shape"},
-    "rotate": {"endpoint": "http://rotate:5001/rotate", "query_arg": "degrees"},
-    "thumbnail": {"endpoint": "http://thumbnail:5002/thumbnail", "query_arg": "size"},
+# The largest request, and so the largest upload, we will accept in bytes.
+app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
+# "local" applies transformations in process, "remote" posts the image to each
+# of the transformation services in turn.
+app.config["TRANSFORM_BACKEND"] = os.environ.get("TRANSFORM_BACKEND", "local")
+# How images are sent to the transformation services, either "multipart" or
+# "raw", and how many connections to keep open to each of them.
+app.config["TRANSFORM_TRANSPORT"] = os.environ.get("TRANSFORM_TRANSPORT", "multipart")
+app.config["TRANSFORM_POOL_SIZE"] = 10
+# Size limits in bytes for the cache of rendered images.
+app.config["DERIVED_CACHE_MEMORY_LIMIT"] = 64 * 1024 * 1024
+app.config["DERIVED_CACHE_DISK_LIMIT"] = 1024 * 1024 * 1024
+# How long in seconds clients and CDNs may reuse an image without revalidating.
+app.config["IMAGE_MAX_AGE"] = 24 * 60 * 60
+# Images fetched from urls are kept under TMP/fetched, and are revalidated with
+# the origin once they are older than FETCH_MAX_AGE seconds.
+app.config["FETCH_MAX_BYTES"] = 50 * 1024 * 1024
+app.config["FETCH_CACHE_LIMIT"] = 1024 * 1024 * 1024
+app.config["FETCH_MAX_AGE"] = 5 * 60
+app.config["FETCH_TIMEOUT"] = 10
+# Renditions that are rendered in the background as soon as an image is
+# uploaded, and then served from the image store. Requests for an image with
+# exactly these arguments are served the rendition.
+app.config["RENDITION_PRESETS"] = {
+    "thumbnail": {"format": "PNG", "thumbnail": "200,200"},
+    "large": {"format": "JPEG", "thumbnail": "800,800", "quality": "80"},
 }
+app.config["RENDITION_WORKERS"] = 2
+# The number of jobs a /batch request may have, and how many are rendered at
+# once.
+app.config["BATCH_MAX_JOBS"] = 100
+app.config["BATCH_WORKERS"] = 8
+# Rendered images with at least this many pixels are sent as they are encoded,
+# on one of ENCODE_WORKERS threads, rather than once the encode has finished.
+app.config["STREAM_MIN_PIXELS"] = 4 * 1000 * 1000
+app.config["ENCODE_WORKERS"] = 8
+# How long in seconds a worker waits for another on the host to finish the same
+# render, before rendering it itself.
+app.config["FLIGHT_TIMEOUT"] = 30
+# format=auto picks the first of these the client lists in its Accept header,
+# or keeps the format of the source image.
+app.config["AUTO_FORMATS"] = ["AVIF", "WEBP"]
+# Encoder options for each format, trading the time spent encoding against the
+# size of the image. A preset is picked with the preset query arg, or else
+# ENCODER_PRESET if it is set, and any quality or compress_level given is used
+# over the preset's.
+app.config["ENCODER_PRESET"] = None
+app.config["ENCODER_PRESETS"] = {
+    "fast": {
+        "AVIF": {"speed": 10},
+        "JPEG": {"quality": 75},
+        "PNG": {"compress_level": 1},
+        "WEBP": {"quality": 75, "method": 0},
+    },
+    "balanced": {
+        "AVIF": {"speed": 6},
+        "JPEG": {"quality": 75, "optimize": True},
+        "PNG": {"compress_level": 6},
+        "WEBP": {"quality": 80, "method": 4},
+    },
+    "small": {
+        "AVIF": {"speed": 2},
+        "JPEG": {"quality": 70, "optimize": True, "progressive": True},
+        "PNG": {"optimize": True},
+        "WEBP": {"quality": 75, "method": 6},
+    },
+}
+# When set to a list of lengths, each side of a requested thumbnail is snapped
+# to one of them, so that fewer variants of each image are rendered and cached.
+app.config["THUMBNAIL_BUCKETS"] = None
+# Images with more pixels than this are rejected before they are decoded, as
+# are requests estimated to read or write more pixels than the work budget.
+app.config["MAX_IMAGE_PIXELS"] = 50 * 1000 * 1000
+app.config["WORK_BUDGET"] = 4 * 1000 * 1000 * 1000
 
 
-# from the flask docs.
-class InvalidUsage(Exception):
-    status_code = 400
-
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
-
-    def to_dict(self):
-        rv = dict(self.payload or ())
-        rv["message"] = self.message
-        return rv
+metrics.init_app(app)
 
+# What the transformation services send between themselves, when the web
+# service asks for an intermediate image.
+INTERMEDIATE_FORMAT = {"format": "PNG", "compress_level": 1}
+# The modes a PNG can store. Others, such as CMYK, are converted to RGB first.
+PNG_MODES = {"1", "L", "LA", "I", "I;16", "P", "RGB", "RGBA"}
 
-class BadPayload(InvalidUsage):
-    pass
+TRANSFORMATIONS = {
+    "filter": {
+        "endpoint": "http://filter:5003/filter",
+        "ops_endpoint": "http://filter:5003/ops",
+        "query_arg": "effect",
+        # Further query args the transformation takes, and their names in a step.
+        "options": {"radius": "radius", "percent": "percent", "threshold": "threshold"},
+    },
+    "mask": {
+        "endpoint": "http://mask:5004/mask",
+        "ops_endpoint": "http://mask:5004/ops",
+        "query_arg": "shape",
+        "options": {"feather": "feather"},
+    },
+    "rotate": {
+        "endpoint": "http://rotate:5001/rotate",
+        "ops_endpoint": "http://rotate:5001/ops",
+        "query_arg": "degrees",
+        "options": {"expand": "expand", "resample": "resample"},
+    },
+    "thumbnail": {
+        "endpoint": "http://thumbnail:5002/thumbnail",
+        "ops_endpoint": "http://thumbnail:5002/ops",
+        "query_arg": "size",
+        "options": {
+            "mode": "mode",
+            "resample": "resample",
+            "reducing_gap": "reducing_gap",
+        },
+    },
+}
 
 
 @app.route("/")
@@ -46,41 +152,463 @@ def hello_world():
     return "Hello, Heycar!"
 
 
+@app.errorhandler(InvalidUsage)
+def handle_invalid_usage(error):
+    response = jsonify(error.to_dict())
+    response.status_code = error.status_code
+    return response
+
+
 @app.route("/upload", methods=["POST"])
 def upload():
-    if "file" not in request.files:
-        raise InvalidUsage(
-            "The payload must contain a file in requestfiles with the key 'file'"
+    """
+    Accepts either a multipart form with the image under 'file', or the image
+    as the raw request body.
+    """
+    if request.mimetype == "application/octet-stream" or request.mimetype.startswith(
+        "image/"
+    ):
+        stream = request.stream
+    else:
+        if "file" not in request.files:
+            raise InvalidUsage(
+                "The payload must contain a file in requestfiles with the key 'file'"
+            )
+        file = request.files["file"]
+        if file.filename == "":
+            raise BadPayload("There was no uploaded file")
+        stream = file.stream
+    with metrics.timed("upload"):
+        image_id = ingest.store(
+            stream,
+            get_store(),
+            app.config["MAX_CONTENT_LENGTH"],
+            app.config["MAX_IMAGE_PIXELS"],
         )
-    file = request.files["file"]
-    if file.filename == "":
-        raise BadPayload("There was no uploaded file")
-    image_id = str(uuid.uuid4())
-    file.save(os.path.join(app.config["IMAGES"], image_id))
+    if app.config["RENDITION_PRESETS"]:
+        get_rendition_executor().submit(render_renditions, image_id)
     return image_id
 
 
+def get_rendition_executor():
+    if "rendition_executor" not in app.extensions:
+        app.extensions["rendition_executor"] = ThreadPoolExecutor(
+            max_workers=app.config["RENDITION_WORKERS"]
+        )
+    return app.extensions["rendition_executor"]
+
+
+def render_renditions(image_id):
+    """
+    Renders each of the presets for the image that has not been rendered
+    already.
+    """
+    store = get_store()
+    in_path = store.path(image_id)
+    for preset, args in app.config["RENDITION_PRESETS"].items():
+        if os.path.exists(store.rendition_path(image_id, preset)):
+            continue
+        try:
+            # render_image only needs the args from the request.
+            buffer, _ = render_image(types.SimpleNamespace(args=args), in_path)
+        except Exception:
+            app.logger.exception(f"Rendering {preset} for {image_id} failed")
+            continue
+        store.add_rendition(image_id, preset, buffer.getvalue())
+
+
+def find_rendition(request):
+    """
+    Returns the path and format of the rendition matching the request, if one
+    has been rendered.
+    """
+    image_id = request.args.get("image_id")
+    if not image_id:
+        return None
+    render_args = get_render_args(request.args)
+    for preset, args in app.config["RENDITION_PRESETS"].items():
+        if get_render_args(args) == render_args:
+            path = get_store().rendition_path(image_id, preset)
+            if os.path.exists(path):
+                return path, args["format"]
+    return None
+
+
 @app.route("/image", methods=["GET"])
 def get_image():
     """
     Uses the image id or url to obtain the image, and then applies effects.
     """
-    buffer, file_format = convert_image(request)
-    buffer = apply_transformations(request, buffer)
-    return send_file(buffer, mimetype=f"image/{file_format}")
+    # the rest of the pipeline only needs the args, with the format chosen.
+    job = types.SimpleNamespace(
+        args=negotiate_format(request.args, request.accept_mimetypes)
+    )
+    in_path = get_in_path(job)
+    key = get_cache_key(job, in_path)
+    # The key identifies both the source and every argument used to render it,
+    # so it doubles as the etag, and we can answer conditional requests without
+    # decoding anything.
+    last_modified = get_last_modified(job, in_path)
+    if not is_resource_modified(request.environ, etag=key, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        f, file_format = get_rendered_image(job, in_path, key)
+        response = send_file(f, mimetype=f"image/{file_format}")
+    if job.args is not request.args:
+        response.vary.add("Accept")
+    return add_cache_headers(response, key, last_modified)
 
 
-def convert_image(request):
+def negotiate_format(args, accept_mimetypes):
     """
-    Get a buffer containing the image, before applying any
-    transformations.
+    With format=auto, the image is sent in the first of AUTO_FORMATS that the
+    client lists in its Accept header, or else in the format of the source
+    image. Wildcards are not enough, as most clients send */*.
+
+    Returns the args with the format chosen, or unchanged if it was not auto.
+    """
+    if str(args.get("format", "")).lower() != "auto":
+        return args
+    args = {name: value for name, value in args.items() if name != "format"}
+    accepted = {mimetype for mimetype, quality in accept_mimetypes if quality}
+    Image.init()
+    for file_format in app.config["AUTO_FORMATS"]:
+        if file_format in Image.SAVE and f"image/{file_format.lower()}" in accepted:
+            args["format"] = file_format
+            break
+    return args
+
+
+def get_rendered_image(request, in_path, key):
+    """
+    Returns a file object containing the rendered image and its format, from a
+    stored rendition or the cache where possible.
+    """
+    rendition = find_rendition(request)
+    if rendition:
+        path, file_format = rendition
+        return open(path, "rb"), file_format
+
+    with metrics.timed("cache"):
+        cached = get_derived_cache().get(key)
+    if not cached:
+        # Identical requests that arrive while the image is being rendered
+        # wait for that render, rather than each starting their own.
+        with metrics.timed("render"):
+            cached = get_flights().do(key, lambda: render_once(request, in_path, key))
+    data, file_format = cached
+    if isinstance(data, EncodeStream):
+        return data.reader(), file_format
+    return io.BytesIO(data), file_format
+
+
+def render_once(request, in_path, key):
+    """
+    Renders the image and caches it, unless another worker on the host has
+    done so while this one waited for the lock. Returns the rendered bytes and
+    their format.
+    """
+    derived_cache = get_derived_cache()
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(get_flights().host_lock(key))
+        cached = derived_cache.get(key)
+        if cached:
+            return cached
+        admit(request, in_path)
+        if app.config["TRANSFORM_BACKEND"] == "remote":
+            buffer, file_format = transform_remotely(request, in_path, stream=True)
+        else:
+            buffer, file_format = render_image(request, in_path, stream=True)
+        if isinstance(buffer, EncodeStream):
+            # Other workers wait for the lock until the image is encoded and
+            # cached, while this one streams it.
+            buffer.add_done_callback(
+                functools.partial(cache_stream, key, file_format, stack.pop_all())
+            )
+            return buffer, file_format
+        data = buffer.getvalue()
+        derived_cache.put(key, data, file_format)
+    return data, file_format
+
+
+def cache_stream(key, file_format, lock, stream):
+    with lock:
+        if stream.error is None:
+            get_derived_cache().put(key, stream.getvalue(), file_format)
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
     """
+    Renders many images in one request. The body is json, with a list of jobs
+    under "jobs", each of which has the same arguments as /image.
+
+    The jobs are rendered concurrently, and the images are streamed back in a
+    zip file as they are finished. The zip ends with a manifest.json that has
+    the file name, or the error, for each job.
+    """
+    jobs = (request.get_json(silent=True) or {}).get("jobs")
+    if not isinstance(jobs, list):
+        raise InvalidUsage("The payload must be json with a list of jobs.")
+    if len(jobs) > app.config["BATCH_MAX_JOBS"]:
+        raise InvalidUsage(
+            f"A batch can have at most {app.config['BATCH_MAX_JOBS']} jobs."
+        )
+    executor = get_batch_executor()
+    futures = {
+        executor.submit(render_job, job, request.accept_mimetypes): index
+        for index, job in enumerate(jobs)
+    }
+    return app.response_class(
+        stream_zip(futures, len(jobs)), mimetype="application/zip"
+    )
+
+
+def get_batch_executor():
+    if "batch_executor" not in app.extensions:
+        app.extensions["batch_executor"] = ThreadPoolExecutor(
+            max_workers=app.config["BATCH_WORKERS"]
+        )
+    return app.extensions["batch_executor"]
+
+
+def render_job(job, accept_mimetypes):
+    if not isinstance(job, dict):
+        raise InvalidUsage("Each job must be an object of /image arguments.")
+    # the rest of the pipeline only needs the args from the request.
+    args = {name: str(value) for name, value in job.items()}
+    request = types.SimpleNamespace(args=negotiate_format(args, accept_mimetypes))
     in_path = get_in_path(request)
+    f, file_format = get_rendered_image(
+        request, in_path, get_cache_key(request, in_path)
+    )
+    with f:
+        return f.read(), file_format
+
+
+def stream_zip(futures, count):
+    buffer = StreamBuffer()
+    manifest = [None] * count
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                data, file_format = future.result()
+            except InvalidUsage as e:
+                manifest[index] = {"error": e.message}
+                continue
+            except Exception as e:
+                app.logger.exception(f"Rendering batch job {index} failed")
+                manifest[index] = {"error": str(e) or type(e).__name__}
+                continue
+            name = f"{index}.{file_format.lower()}"
+            zip_file.writestr(name, data)
+            manifest[index] = {"file": name}
+            yield buffer.drain()
+        zip_file.writestr("manifest.json", json.dumps(manifest))
+    yield buffer.drain()
+
+
+class StreamBuffer(io.RawIOBase):
+    """
+    A write only file, so that a zip file can be streamed as it is written.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+@app.route("/images/<image_id>", methods=["GET"])
+def get_original(image_id):
+    """
+    Serves a stored image as it was uploaded, with support for conditional
+    and range requests.
+    """
+    path = get_store().path(image_id)
+    if not os.path.exists(path):
+        abort(404)
+    metadata = get_store().metadata(image_id)
+    mimetype = f"image/{metadata['format']}" if metadata else None
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["IMAGE_MAX_AGE"]
+    return response
+
+
+def get_last_modified(request, in_path):
+    """
+    Stored images are only written once, so the time they were uploaded is
+    when every image derived from them last changed.
+    """
+    image_id = request.args.get("image_id")
+    if not image_id:
+        return None
+    metadata = get_store().metadata(image_id)
+    # images stored before the index was added fall back to the file.
+    created = metadata["created"] if metadata else os.path.getmtime(in_path)
+    return datetime.datetime.utcfromtimestamp(int(created))
+
+
+def admit(request, in_path):
+    """
+    Rejects the request if rendering it is estimated to be too expensive, using
+    the dimensions from the index, or the header of the image, so that nothing
+    is decoded first.
+    """
+    image_id = request.args.get("image_id")
+    metadata = get_store().metadata(image_id) if image_id else None
+    if metadata:
+        size = pipeline.get_oriented_size(
+            (metadata["width"], metadata["height"]), metadata["orientation"]
+        )
+        file_format = metadata["format"]
+    else:
+        size, file_format = admission.read_header(in_path)
+    admission.check(
+        size,
+        file_format,
+        get_planned_steps(request.args),
+        app.config["MAX_IMAGE_PIXELS"],
+        app.config["WORK_BUDGET"],
+    )
+
+
+def add_cache_headers(response, etag, last_modified=None):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["IMAGE_MAX_AGE"]
+    return response
+
+
+def get_store():
+    if "store" not in app.extensions:
+        app.extensions["store"] = ImageStore(app.config["IMAGES"])
+    return app.extensions["store"]
+
+
+def get_derived_cache():
+    if "derived_cache" not in app.extensions:
+        app.extensions["derived_cache"] = DerivedCache(
+            os.path.join(app.config["TMP"], "derived"),
+            memory_limit=app.config["DERIVED_CACHE_MEMORY_LIMIT"],
+            disk_limit=app.config["DERIVED_CACHE_DISK_LIMIT"],
+        )
+    return app.extensions["derived_cache"]
+
+
+def get_flights():
+    if "flights" not in app.extensions:
+        app.extensions["flights"] = SingleFlight(
+            os.path.join(app.config["TMP"], "flights"), app.config["FLIGHT_TIMEOUT"]
+        )
+    return app.extensions["flights"]
+
+
+def get_fetcher():
+    if "fetcher" not in app.extensions:
+        app.extensions["fetcher"] = RemoteFetcher(
+            os.path.join(app.config["TMP"], "fetched"),
+            max_bytes=app.config["FETCH_MAX_BYTES"],
+            disk_limit=app.config["FETCH_CACHE_LIMIT"],
+            max_age=app.config["FETCH_MAX_AGE"],
+            timeout=app.config["FETCH_TIMEOUT"],
+        )
+    return app.extensions["fetcher"]
+
+
+def get_cache_key(request, in_path):
+    """
+    Stored images never change, so they are identified by their id. Images
+    from a url are identified by a hash of their content, which the fetcher
+    names them by.
+
+    The transformations are normalised in to the order they are applied, so
+    that equivalent requests share a key.
+    """
+    if request.args.get("image_id"):
+        source = {"image_id": request.args["image_id"]}
+    else:
+        source = {"sha256": os.path.basename(in_path)}
+    return cache_key(source, get_render_args(request.args))
+
+
+def get_render_args(args):
+    """
+    Normalise the arguments that affect how an image is rendered.
+    """
+    render_args = {"steps": get_planned_steps(args)}
+    preset = get_encoder_preset(args)
+    if preset:
+        render_args["preset"] = preset
+    file_format = args.get("format")
+    if file_format:
+        render_args["format"] = file_format.upper()
+    for attribute in ["compress_level", "quality"]:
+        value = args.get(attribute)
+        if value:
+            render_args[attribute] = int(value)
+    if args.get("progressive"):
+        render_args["progressive"] = pipeline.parse_bool(args["progressive"])
+    return render_args
+
+
+def render_image(request, in_path=None, stream=False):
+    """
+    Decode the image once, apply all of the transformations to it in process,
+    and then encode it once in the requested format. With stream, large images
+    may be returned as an EncodeStream that is still being written.
+    """
+    if in_path is None:
+        in_path = get_in_path(request)
+    with Image.open(in_path) as im:
+        file_conversion_args = get_file_conversion_args(request, im)
+        steps = get_planned_steps(request.args)
+        pipeline.draft(im, steps)
+        with metrics.timed("decode"):
+            im.load()
+        im = pipeline.run(pipeline.orient(im), steps, file_conversion_args["format"])
+        if stream and is_streamed(im, file_conversion_args["format"]):
+            return (
+                save_streamed(im, **file_conversion_args),
+                file_conversion_args["format"],
+            )
+        return save(im, **file_conversion_args), file_conversion_args["format"]
+
+
+def convert_image(request, in_path=None, stream=False):
+    """
+    Get a buffer containing the image, before applying any
+    transformations, or an EncodeStream as for render_image.
+    """
+    if in_path is None:
+        in_path = get_in_path(request)
 
     # It does not make sense to have compression in its own microservice since it's
     # an attribute of saving, and we do our file format conversion here.
     with Image.open(in_path) as im:
         file_conversion_args = get_file_conversion_args(request, im)
+        with metrics.timed("decode"):
+            im.load()
+        im = pipeline.orient(im)
+        if stream and is_streamed(im, file_conversion_args["format"]):
+            return (
+                save_streamed(im, **file_conversion_args),
+                file_conversion_args["format"],
+            )
         return save(im, **file_conversion_args), file_conversion_args["format"]
 
 
@@ -95,46 +623,272 @@ def get_in_path(request):
         raise InvalidUsage("You must include an image_id or url get parameter.")
 
     if image_id:
-        return os.path.join(app.config["IMAGES"], image_id)
-    return io.BytesIO(requests.get(url).content)
+        path = get_store().path(image_id)
+        if not os.path.exists(path):
+            raise InvalidUsage(f"There is no image {image_id}", status_code=404)
+        return path
+    with metrics.timed("fetch"):
+        return get_fetcher().fetch(url)
 
 
 def get_file_conversion_args(request, im):
     # if we have not specified a new format, retain the old format.
     file_format = request.args.get("format") or im.format
     file_conversion_args = {"format": file_format}
+    preset = get_encoder_preset(request.args)
+    if preset:
+        presets = app.config["ENCODER_PRESETS"][preset]
+        file_conversion_args.update(presets.get(file_format.upper(), {}))
     # compress level for pngs, quality for jpegs.
     for attribute in ["compress_level", "quality"]:
         value = request.args.get(attribute)
         if value:
             file_conversion_args[attribute] = int(value)
+    # Progressive JPEGs can be shown, blurry at first, before they have
+    # arrived. Pillow can not write interlaced PNGs.
+    if request.args.get("progressive") and file_format.upper() == "JPEG":
+        file_conversion_args["progressive"] = pipeline.parse_bool(
+            request.args["progressive"]
+        )
     return file_conversion_args
 
 
+def get_encoder_preset(args):
+    preset = args.get("preset") or app.config["ENCODER_PRESET"]
+    if preset and preset not in app.config["ENCODER_PRESETS"]:
+        raise InvalidUsage(
+            f"preset must be one of {', '.join(app.config['ENCODER_PRESETS'])}."
+        )
+    return preset
+
+
 def save(im, **file_conversion_args):
     buffer = io.BytesIO()
-    try:
-        im.save(buffer, **file_conversion_args)
-    except OSError:
-        # Trick for converting rgba type formats to jpeg.
-
-        # credit: https://stackoverflow.com/a/9459208/2610613
-        rgb = Image.new("RGB", im.size, (255, 255, 255))
-        rgb.paste(im, mask=im.split()[3])
-        rgb.save(buffer, **file_conversion_args)
+    encode(im, buffer, **file_conversion_args)
+    metrics.count_bytes("encode", buffer.tell())
     buffer.seek(0)
     return buffer
 
 
-def apply_transformations(request, buffer):
+def save_streamed(im, **file_conversion_args):
     """
-    Takes the existing buffer, and applies transformations in sequence,
-    returning the final buffer
+    Encodes the image on another thread, returning an EncodeStream of it
+    straight away.
     """
-    for transformation, details in TRANSFORMATIONS.items():
-        param = request.args.get(transformation)
-        if param:
-            query_params = urllib.parse.urlencode({details["query_arg"]: param})
-            url = f"{details['endpoint']}?{query_params}"
-            buffer = io.BytesIO(requests.post(url, files={"file": buffer}).content)
+    stream = EncodeStream()
+
+    def encode_to_stream():
+        try:
+            encode(im, stream, **file_conversion_args)
+        except Exception as e:
+            app.logger.exception("Encoding a streamed image failed")
+            stream.finish(e)
+        else:
+            stream.finish()
+
+    get_encode_executor().submit(encode_to_stream)
+    return stream
+
+
+def encode(im, f, **file_conversion_args):
+    with metrics.timed("encode"):
+        try:
+            im.save(f, **file_conversion_args)
+        except OSError:
+            # Trick for converting rgba type formats to jpeg.
+
+            # credit: https://stackoverflow.com/a/9459208/2610613
+            pipeline.flatten(im).save(f, **file_conversion_args)
+
+
+def is_streamed(im, file_format):
+    return (
+        file_format.upper() in STREAMABLE_FORMATS
+        and im.width * im.height >= app.config["STREAM_MIN_PIXELS"]
+    )
+
+
+def get_encode_executor():
+    if "encode_executor" not in app.extensions:
+        app.extensions["encode_executor"] = ThreadPoolExecutor(
+            max_workers=app.config["ENCODE_WORKERS"]
+        )
+    return app.extensions["encode_executor"]
+
+
+def get_planned_steps(args):
+    """
+    The transformations given as separate query args are reordered to shrink
+    the image as early as possible, see pipeline.plan, but an ops list is run
+    in the order it was given.
+    """
+    steps = get_steps(args)
+    if args.get("ops"):
+        return steps
+    return pipeline.plan(steps)
+
+
+def get_steps(args):
+    """
+    Build the list of transformation steps requested in the query args.
+
+    The steps can be given in order as a json list under ops, for example
+    [{"op": "rotate", "degrees": "90"}, {"op": "filter", "effect": "blur"}],
+    or as one query arg per transformation, which are applied in a fixed order.
+    """
+    if args.get("ops"):
+        steps = get_ordered_steps(args)
+    else:
+        steps = []
+        for transformation, details in TRANSFORMATIONS.items():
+            param = args.get(transformation)
+            if param:
+                step = {"op": transformation, details["query_arg"]: param}
+                for query_arg, option in details.get("options", {}).items():
+                    if args.get(query_arg):
+                        step[option] = args[query_arg]
+                steps.append(step)
+    for step in steps:
+        try:
+            pipeline.check_step(step)
+        except ValueError as error:
+            raise InvalidUsage(str(error))
+        if step["op"] == "thumbnail":
+            check_thumbnail(step)
+    buckets = app.config["THUMBNAIL_BUCKETS"]
+    if buckets:
+        for step in steps:
+            if step["op"] == "thumbnail":
+                step["size"] = snap_size(step["size"], buckets)
+    return steps
+
+
+def check_thumbnail(step):
+    """
+    Padded and cropped thumbnails are made at exactly their size, so it is
+    held to the same limit as the images themselves.
+    """
+    size = pipeline.parse_size(step["size"])
+    admission.check_pixels(size, app.config["MAX_IMAGE_PIXELS"])
+
+
+def snap_size(size, buckets):
+    """
+    Rounds each side of the size up to the next bucket, or down to the largest
+    one.
+    """
+    sides = []
+    for side in pipeline.parse_size(size):
+        larger = [bucket for bucket in buckets if bucket >= side]
+        sides.append(min(larger) if larger else max(buckets))
+    return ",".join(str(side) for side in sides)
+
+
+def get_ordered_steps(args):
+    if any(args.get(transformation) for transformation in TRANSFORMATIONS):
+        raise InvalidUsage("ops can not be combined with other transformations.")
+    try:
+        ops = json.loads(args["ops"])
+    except ValueError:
+        raise InvalidUsage("ops must be a json list.")
+    if not isinstance(ops, list):
+        raise InvalidUsage("ops must be a json list.")
+    steps = []
+    for op in ops:
+        details = TRANSFORMATIONS.get(op.get("op")) if isinstance(op, dict) else None
+        if details is None:
+            raise InvalidUsage(f"Each op must be one of {', '.join(TRANSFORMATIONS)}.")
+        if op.get(details["query_arg"]) in (None, ""):
+            raise InvalidUsage(f"{op['op']} ops need a {details['query_arg']}.")
+        step = {"op": op["op"], details["query_arg"]: str(op[details["query_arg"]])}
+        for option in details.get("options", {}).values():
+            if op.get(option) not in (None, ""):
+                step[option] = str(op[option])
+        steps.append(step)
+    return steps
+
+
+def transform_remotely(request, in_path, stream=False):
+    """
+    Applies the transformations using the transformation services.
+
+    The services pass a fast, lossless PNG between them, so that the image is
+    only encoded in the requested format once, after the last step, rather
+    than losing quality and time to an encode in every service.
+    """
+    if not get_steps(request.args):
+        return convert_image(request, in_path, stream)
+
+    with Image.open(in_path) as im:
+        file_conversion_args = get_file_conversion_args(request, im)
+        im = pipeline.orient(im)
+        if im.mode not in PNG_MODES:
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        buffer = save(im, **INTERMEDIATE_FORMAT)
+    buffer = apply_transformations(
+        request, buffer, INTERMEDIATE_FORMAT["format"], intermediate=True
+    )
+    with Image.open(buffer) as im:
+        if stream and is_streamed(im, file_conversion_args["format"]):
+            im.load()
+            return (
+                save_streamed(im, **file_conversion_args),
+                file_conversion_args["format"],
+            )
+        return save(im, **file_conversion_args), file_conversion_args["format"]
+
+
+def apply_transformations(request, buffer, file_format=None, intermediate=False):
+    """
+    Takes the existing buffer, and applies transformations in sequence
+    using the transformation services, returning the final buffer
+    """
+    steps = get_planned_steps(request.args)
+    # Consecutive steps for the same service are sent to it in one request.
+    for transformation, group in itertools.groupby(steps, key=lambda s: s["op"]):
+        group = list(group)
+        if len(group) == 1:
+            params = {key: value for key, value in group[0].items() if key != "op"}
+            query_params = urllib.parse.urlencode(params)
+            url = f"{TRANSFORMATIONS[transformation]['endpoint']}?{query_params}"
+        else:
+            query_params = urllib.parse.urlencode({"ops": json.dumps(group)})
+            url = f"{TRANSFORMATIONS[transformation]['ops_endpoint']}?{query_params}"
+        session = get_transform_session(transformation)
+        kwargs = {"files": {"file": buffer}}
+        headers = {}
+        if app.config["TRANSFORM_TRANSPORT"] == "raw":
+            # Sending the image as the body saves building and parsing a
+            # multipart form on every hop.
+            kwargs = {"data": buffer}
+            headers["Content-Type"] = "application/octet-stream"
+            if file_format:
+                headers["X-Image-Format"] = file_format
+        if intermediate:
+            headers["X-Intermediate"] = "1"
+        if metrics.get_request_id():
+            headers["X-Request-ID"] = metrics.get_request_id()
+        if headers:
+            kwargs["headers"] = headers
+        with metrics.timed(f"hop_{transformation}"):
+            content = session.post(url, **kwargs).content
+        metrics.count_bytes(f"hop_{transformation}", len(content))
+        buffer = io.BytesIO(content)
     return buffer
+
+
+def get_transform_session(transformation):
+    """
+    Each transformation service gets its own session, so that connections to
+    it are kept alive and reused between requests.
+    """
+    sessions = app.extensions.setdefault("transform_sessions", {})
+    if transformation not in sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=app.config["TRANSFORM_POOL_SIZE"]
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        sessions[transformation] = session
+    return sessions[transformation]
@@ -0,0 +1,150 @@
+"""
+Stores images in sharded subdirectories, alongside an sqlite index of their
+metadata that is written once, when they are uploaded.
+"""
+from contextlib import closing
+import hashlib
+import os
+import sqlite3
+import tempfile
+import time
+
+from PIL import Image
+
+from errors import InvalidUsage
+import pipeline
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL UNIQUE,
+    format TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    orientation INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    created REAL NOT NULL
+)
+"""
+COLUMNS = [
+    "id",
+    "sha256",
+    "format",
+    "width",
+    "height",
+    "mode",
+    "orientation",
+    "bytes",
+    "created",
+]
+
+
+# Ids can not start with a ".", so nothing here can be served as an image.
+INDEX_NAME = ".index.sqlite3"
+RENDITIONS_NAME = ".renditions"
+
+
+class ImageStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self._schema_created = False
+
+    def path(self, image_id):
+        """
+        Images are sharded in to two levels of subdirectories by a hash of
+        their id, so that no one directory grows too large. Images stored before
+        sharding are still found at the top level.
+        """
+        path = os.path.join(self.directory, self._shard(image_id), image_id)
+        flat_path = os.path.join(self.directory, image_id)
+        # Only files, so that the shard directories are never served.
+        if not os.path.exists(path) and os.path.isfile(flat_path):
+            return flat_path
+        return path
+
+    def rendition_path(self, image_id, preset):
+        """
+        Renditions of an image that are rendered ahead of time are stored
+        outside of the image shards, by the name of their preset.
+        """
+        return os.path.join(
+            self.directory, RENDITIONS_NAME, self._shard(image_id), image_id, preset
+        )
+
+    def add_rendition(self, image_id, preset, data):
+        path = self.rendition_path(image_id, preset)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        with os.fdopen(handle, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def add(self, image_id, tmp_path, sha256):
+        """
+        Moves the image at tmp_path in to the store and indexes it, returning
+        its id. If an image with the same content is already stored, the file
+        at tmp_path is removed and the id of the existing image is returned.
+        """
+        existing = self.find(sha256)
+        if existing:
+            os.remove(tmp_path)
+            return existing["id"]
+
+        with Image.open(tmp_path) as im:
+            metadata = (
+                image_id,
+                sha256,
+                im.format,
+                im.width,
+                im.height,
+                im.mode,
+                pipeline.get_orientation(im),
+                os.path.getsize(tmp_path),
+                time.time(),
+            )
+        path = self.path(image_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.execute(
+                    f"INSERT INTO images VALUES ({', '.join('?' * len(COLUMNS))})",
+                    metadata,
+                )
+        except sqlite3.IntegrityError:
+            # An identical image was uploaded at the same time.
+            os.remove(path)
+            return self.find(sha256)["id"]
+        return image_id
+
+    def metadata(self, image_id):
+        return self._get("id", image_id)
+
+    def find(self, sha256):
+        return self._get("sha256", sha256)
+
+    def _get(self, column, value):
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM images WHERE {column} = ?",
+                (value,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(COLUMNS, row))
+
+    def _shard(self, image_id):
+        if not image_id or os.sep in image_id or image_id.startswith("."):
+            raise InvalidUsage("That is not a valid image_id.")
+        digest = hashlib.md5(image_id.encode()).hexdigest()
+        return os.path.join(digest[:2], digest[2:4])
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=30)
+        if not self._schema_created:
+            with connection:
+                connection.execute(SCHEMA)
+            self._schema_created = True
+        return connection
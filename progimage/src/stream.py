@@ -0,0 +1,107 @@
+"""
+Lets a response start while its image is still being encoded, so that the
+time to the first byte of a large image does not include the whole encode.
+
+The encoder writes to an EncodeStream on another thread, and each response
+reads it through its own StreamReader, blocking until the next chunk has been
+written. The chunks are kept, so that requests that join a render late still
+get the whole image, and so that it can be cached once it is complete. So the
+whole image is still held in memory, as it would be without streaming.
+"""
+import io
+import threading
+
+# Formats that Pillow writes out as it encodes them. Others, such as WEBP, are
+# written all at once at the end, so there is nothing to gain.
+STREAMABLE_FORMATS = {"JPEG", "PNG"}
+
+
+class EncodeStream:
+    def __init__(self):
+        self.error = None
+        self._chunks = []
+        self._done = False
+        self._callbacks = []
+        self._condition = threading.Condition()
+
+    def write(self, b):
+        # An empty chunk would be read as the end of the stream.
+        if not len(b):
+            return 0
+        with self._condition:
+            self._chunks.append(bytes(b))
+            self._condition.notify_all()
+        return len(b)
+
+    def finish(self, error=None):
+        """
+        Marks the stream as complete, or as failed with the error, which is
+        then raised to its readers once they have read what was written.
+        """
+        with self._condition:
+            self._done = True
+            self.error = error
+            self._condition.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """
+        Calls the callback with the stream once it is finished, straight away
+        if it already is.
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def get_chunk(self, index):
+        """
+        Waits for the chunk at the index, returning b"" if the stream finished
+        without one.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: index < len(self._chunks) or self._done)
+            if index < len(self._chunks):
+                return self._chunks[index]
+        if self.error is not None:
+            raise self.error
+        return b""
+
+    def getvalue(self):
+        """
+        Waits for the stream to finish, and returns everything written to it.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._done)
+        if self.error is not None:
+            raise self.error
+        return b"".join(self._chunks)
+
+    def reader(self):
+        return StreamReader(self)
+
+
+class StreamReader(io.RawIOBase):
+    """
+    A read only file of the stream, from its start.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._index = 0
+        self._pending = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._pending:
+            self._pending = memoryview(self.stream.get_chunk(self._index))
+            self._index += 1
+        size = min(len(b), len(self._pending))
+        b[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
@@ -1,21 +1,42 @@
 import glob
+import hashlib
 from io import BytesIO
+import json
+import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import urllib.parse
+import zipfile
 
 from unittest import mock
 
-from PIL import Image
+from PIL import Image, ImageFilter
 
+import admission
+from cache import DerivedCache
+from fetch import RemoteFetcher
+from flight import SingleFlight
+from store import ImageStore
+from stream import EncodeStream
+import pipeline
 from progimage import (
     app,
     apply_transformations,
     convert_image,
+    get_cache_key,
     get_file_conversion_args,
     get_in_path,
+    get_steps,
+    get_store,
+    get_transform_session,
+    render_image,
+    render_renditions,
     save,
-    BadPayload,
+    save_streamed,
+    transform_remotely,
     InvalidUsage,
 )
 
@@ -24,6 +45,13 @@ class TestProgImage(unittest.TestCase):
     def setUp(self):
         app.config["TESTING"] = True
         app.config["IMAGES"] = tempfile.mkdtemp()
+        app.config["TMP"] = tempfile.mkdtemp()
+        app.config["TRANSFORM_BACKEND"] = "local"
+        app.extensions.pop("derived_cache", None)
+        app.extensions.pop("fetcher", None)
+        app.extensions.pop("flights", None)
+        app.extensions.pop("store", None)
+        app.extensions.pop("transform_sessions", None)
         self.client = app.test_client()
 
 
@@ -33,15 +61,74 @@ class TestHelloWorld(TestProgImage):
         self.assertEqual(rv.data, b"Hello, Heycar!")
 
 
+class TestErrors(TestProgImage):
+    """
+    With TESTING off, as in production, errors are sent to the client rather
+    than raised.
+    """
+
+    def setUp(self):
+        super().setUp()
+        app.config["TESTING"] = False
+        self.addCleanup(app.config.update, TESTING=True)
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+
+    @mock.patch.dict(app.config, {"MAX_IMAGE_PIXELS": 100})
+    def test_upload_too_many_pixels(self):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
+                "/upload", content_type="image/png", data=test_image.read()
+            )
+        self.assertEqual(resp.status_code, 413)
+        self.assertIn("pixels", resp.json["message"])
+
+    @mock.patch.dict(app.config, {"WORK_BUDGET": 1000})
+    def test_over_budget(self):
+        resp = self.client.get("/image?image_id=test&filter=blur")
+        self.assertEqual(resp.status_code, 413)
+
+    def test_thumbnail_too_large(self):
+        resp = self.client.get(
+            "/image?image_id=test&thumbnail=30000,30000&mode=fill&filter=blur"
+        )
+        self.assertEqual(resp.status_code, 413)
+
+    def test_invalid_rotation(self):
+        for query in ["rotate=abc", "rotate=45&resample=bogus"]:
+            resp = self.client.get(f"/image?image_id=test&{query}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_invalid_thumbnail(self):
+        for query in ["resample=foo", "reducing_gap=x"]:
+            resp = self.client.get(f"/image?image_id=test&thumbnail=50,50&{query}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_invalid_filter(self):
+        for query in ["filter=bogus", "filter=gaussianblur&radius=abc"]:
+            resp = self.client.get(f"/image?image_id=test&{query}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_unknown_preset(self):
+        resp = self.client.get("/image?image_id=test&preset=bogus")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("preset", resp.json["message"])
+
+
 class TestUpload(TestProgImage):
     empty_file = (BytesIO(), "")
     test_file = (BytesIO(b"contents"), "test.file")
 
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("progimage.get_rendition_executor")
+        self.executor_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_upload_without_files(self):
-        with self.assertRaises(InvalidUsage):
-            self.client.post(
-                "/upload", content_type="multipart/form-data", data={},
-            )
+        resp = self.client.post(
+            "/upload", content_type="multipart/form-data", data={},
+        )
+        self.assertEqual(resp.status_code, 400)
 
     def test_upload_without_file(self):
         """
@@ -49,23 +136,126 @@ class TestUpload(TestProgImage):
         is tricked in to thinking we have uploaded a payload
         with 'file' empty
         """
-        with self.assertRaises(BadPayload):
-            self.client.post(
+        resp = self.client.post(
+            "/upload",
+            content_type="multipart/form-data",
+            data={"file": self.empty_file},
+        )
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json, {"message": "There was no uploaded file"})
+
+    @mock.patch("uuid.uuid4", return_value="fake_uuid")
+    def test_upload(self, uuid_mock):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
                 "/upload",
                 content_type="multipart/form-data",
-                data={"file": self.empty_file},
+                data={"file": (test_image, "steve.png")},
             )
+        uploaded_files = glob.glob(f"{app.config['IMAGES']}/*/*/*")
+        self.assertEqual(resp.data, b"fake_uuid")
+        self.assertEqual(uploaded_files, [get_store().path("fake_uuid")])
+        self.executor_mock.return_value.submit.assert_called_with(
+            render_renditions, "fake_uuid"
+        )
 
-    @mock.patch("uuid.uuid4", return_value="fake_uuid")
-    def test_upload(self, uuid_mock):
+    def test_upload_not_an_image(self):
         resp = self.client.post(
             "/upload",
             content_type="multipart/form-data",
             data={"file": self.test_file},
         )
-        uploaded_files = glob.glob(f"{app.config['IMAGES']}/*")
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(glob.glob(f"{app.config['IMAGES']}/*/*/*"), [])
+
+    @mock.patch("uuid.uuid4", return_value="fake_uuid")
+    def test_upload_raw_body(self, uuid_mock):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
+                "/upload", content_type="image/png", data=test_image.read()
+            )
         self.assertEqual(resp.data, b"fake_uuid")
-        self.assertEqual(uploaded_files, [f"{app.config['IMAGES']}/fake_uuid"])
+
+    def test_duplicate_upload(self):
+        with open("fixtures/steve.png", "rb") as test_image:
+            content = test_image.read()
+        first = self.client.post("/upload", content_type="image/png", data=content)
+        second = self.client.post("/upload", content_type="image/png", data=content)
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(len(glob.glob(f"{app.config['IMAGES']}/*/*/*")), 1)
+
+    @mock.patch.dict(app.config, {"MAX_CONTENT_LENGTH": 100})
+    def test_upload_too_large(self):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
+                "/upload", content_type="image/png", data=test_image.read()
+            )
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual(glob.glob(f"{app.config['IMAGES']}/*/*/*"), [])
+
+    @mock.patch.dict(app.config, {"MAX_IMAGE_PIXELS": 100})
+    def test_upload_too_many_pixels(self):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
+                "/upload", content_type="image/png", data=test_image.read()
+            )
+        self.assertEqual(resp.status_code, 413)
+        self.assertEqual(glob.glob(f"{app.config['IMAGES']}/*/*/*"), [])
+
+    @mock.patch.dict(app.config, {"MAX_CONTENT_LENGTH": 100})
+    def test_multipart_upload_too_large(self):
+        with open("fixtures/steve.png", "rb") as test_image:
+            resp = self.client.post(
+                "/upload",
+                content_type="multipart/form-data",
+                data={"file": (test_image, "steve.png")},
+            )
+        self.assertEqual(resp.status_code, 413)
+
+
+class TestImageStore(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        self.store = ImageStore(tempfile.mkdtemp())
+
+    def add_test_image(self, image_id):
+        _, tmp_path = tempfile.mkstemp(dir=self.store.directory)
+        shutil.copyfile("fixtures/steve.png", tmp_path)
+        return self.store.add(image_id, tmp_path, "fake_sha256")
+
+    def test_sharded_path(self):
+        path = self.store.path("an_id")
+        self.assertEqual(
+            os.path.relpath(path, self.store.directory).split(os.sep)[2], "an_id"
+        )
+
+    def test_flat_path_fallback(self):
+        shutil.copyfile("fixtures/steve.png", f"{self.store.directory}/old")
+        self.assertEqual(self.store.path("old"), f"{self.store.directory}/old")
+
+    def test_invalid_ids(self):
+        for image_id in ["", "../etc/passwd", ".index"]:
+            with self.assertRaises(InvalidUsage):
+                self.store.path(image_id)
+
+    def test_add(self):
+        self.assertEqual(self.add_test_image("an_id"), "an_id")
+        self.assertTrue(os.path.exists(self.store.path("an_id")))
+        metadata = self.store.metadata("an_id")
+        self.assertEqual(metadata["format"], "PNG")
+        self.assertEqual((metadata["width"], metadata["height"]), (269, 269))
+        self.assertEqual(metadata["mode"], "RGBA")
+        self.assertEqual(metadata["orientation"], 1)
+        self.assertEqual(metadata["bytes"], os.path.getsize("fixtures/steve.png"))
+        self.assertEqual(metadata["sha256"], "fake_sha256")
+
+    def test_add_duplicate(self):
+        self.add_test_image("an_id")
+        self.assertEqual(self.add_test_image("another_id"), "an_id")
+        self.assertFalse(os.path.exists(self.store.path("another_id")))
+
+    def test_missing_metadata(self):
+        self.assertIsNone(self.store.metadata("an_id"))
 
 
 class TestGetImage(TestProgImage):
@@ -80,16 +270,561 @@ class TestGetImage(TestProgImage):
             resp.mimetype, "image/PNG", "Assert that the response contains a png"
         )
 
+    def test_auto_format(self):
+        resp = self.client.get(
+            "/image?image_id=test&format=auto",
+            headers={"Accept": "image/webp,image/*,*/*;q=0.8"},
+        )
+        self.assertEqual(resp.mimetype, "image/WEBP")
+        self.assertIn("Accept", resp.vary)
+
+    def test_auto_format_keeps_source_format(self):
+        resp = self.client.get(
+            "/image?image_id=test&format=auto", headers={"Accept": "*/*"}
+        )
+        self.assertEqual(resp.mimetype, "image/PNG")
+        self.assertIn("Accept", resp.vary)
+
+    def test_no_vary_without_auto_format(self):
+        resp = self.client.get("/image?image_id=test&format=png")
+        self.assertNotIn("Accept", resp.vary)
+
+    def test_cmyk_to_png(self):
+        with Image.open("fixtures/steve.png") as im:
+            im.convert("CMYK").save(f"{app.config['IMAGES']}/cmyk", format="JPEG")
+        resp = self.client.get("/image?image_id=cmyk&format=png")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.data)).mode, "RGB")
+
+    def test_cmyk_transformed_remotely(self):
+        def post(url, data=None, files=None, headers=None):
+            image = Image.open(data if data is not None else files["file"])
+            self.assertEqual(image.mode, "RGB")
+            return mock.Mock(content=image.fp.getvalue())
+
+        with Image.open("fixtures/steve.png") as im:
+            im.convert("CMYK").save(f"{app.config['IMAGES']}/cmyk", format="JPEG")
+        app.config["TRANSFORM_BACKEND"] = "remote"
+        session = get_transform_session("rotate")
+        with mock.patch.object(session, "post", post), mock.patch(
+            "pipeline.flatten", wraps=pipeline.flatten
+        ) as flatten_mock:
+            resp = self.client.get("/image?image_id=cmyk&rotate=90")
+        self.assertEqual(resp.status_code, 200)
+        flatten_mock.assert_not_called()
+        self.assertEqual(Image.open(BytesIO(resp.data)).format, "JPEG")
+
     def test_get_non_existant_image(self):
-        with self.assertRaises(FileNotFoundError):
-            self.client.get("/image?image_id=bla")
+        resp = self.client.get("/image?image_id=bla")
+        self.assertEqual(resp.status_code, 404)
 
-    @mock.patch("progimage.apply_transformations", return_value=BytesIO())
+    @mock.patch("progimage.apply_transformations")
     def test_transformations_applied(self, apply_mock):
+        with open("fixtures/steve.png", "rb") as f:
+            apply_mock.return_value = BytesIO(f.read())
+        app.config["TRANSFORM_BACKEND"] = "remote"
         resp = self.client.get("/image?image_id=test&rotate=90")
         self.assertEqual(resp.status_code, 200)
         apply_mock.assert_called_once()
 
+    @mock.patch("requests.post")
+    def test_transformations_applied_in_process(self, post_mock):
+        resp = self.client.get("/image?image_id=test&rotate=90&thumbnail=100,100")
+        self.assertEqual(resp.status_code, 200)
+        post_mock.assert_not_called()
+        self.assertEqual(Image.open(BytesIO(resp.data)).size, (100, 100))
+
+    def test_repeat_request_served_from_cache(self):
+        first = self.client.get("/image?image_id=test&thumbnail=100,100")
+        with mock.patch("progimage.render_image") as render_mock:
+            second = self.client.get("/image?image_id=test&thumbnail=100,100")
+        render_mock.assert_not_called()
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.mimetype, first.mimetype)
+
+    def test_cache_headers(self):
+        resp = self.client.get("/image?image_id=test&rotate=90")
+        self.assertTrue(resp.headers["ETag"])
+        self.assertTrue(resp.headers["Last-Modified"])
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=86400")
+
+    def test_etag_depends_on_transformations(self):
+        first = self.client.get("/image?image_id=test&rotate=90")
+        second = self.client.get("/image?image_id=test&rotate=180")
+        self.assertNotEqual(first.headers["ETag"], second.headers["ETag"])
+
+    def test_not_modified(self):
+        etag = self.client.get("/image?image_id=test&rotate=90").headers["ETag"]
+        with mock.patch("progimage.render_image") as render_mock:
+            resp = self.client.get(
+                "/image?image_id=test&rotate=90", headers={"If-None-Match": etag}
+            )
+        render_mock.assert_not_called()
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers["ETag"], etag)
+        self.assertEqual(resp.data, b"")
+
+
+class TestMetrics(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+
+    def test_server_timing(self):
+        resp = self.client.get("/image?image_id=test&rotate=90")
+        stages = [
+            part.split(";")[0] for part in resp.headers["Server-Timing"].split(", ")
+        ]
+        for stage in ["cache", "decode", "rotate", "encode", "total"]:
+            self.assertIn(stage, stages)
+
+    def test_request_id_generated(self):
+        first = self.client.get("/image?image_id=test")
+        second = self.client.get("/image?image_id=test")
+        self.assertTrue(first.headers["X-Request-ID"])
+        self.assertNotEqual(
+            first.headers["X-Request-ID"], second.headers["X-Request-ID"]
+        )
+
+    def test_request_id_kept(self):
+        resp = self.client.get("/image?image_id=test", headers={"X-Request-ID": "abc"})
+        self.assertEqual(resp.headers["X-Request-ID"], "abc")
+
+    def test_metrics(self):
+        self.client.get("/image?image_id=test&rotate=90")
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'stage_seconds_count{stage="rotate"}', resp.data)
+
+    @mock.patch("requests.Session.post")
+    def test_request_id_passed_on(self, post_mock):
+        post_mock.return_value.content = b"bar"
+        request = mock.MagicMock(args={"rotate": "90"})
+        with app.test_request_context(headers={"X-Request-ID": "abc"}):
+            app.preprocess_request()
+            apply_transformations(request, BytesIO(b"foo"))
+        self.assertEqual(post_mock.call_args[1]["headers"], {"X-Request-ID": "abc"})
+
+
+class TestAdmission(TestProgImage):
+    def test_too_many_pixels(self):
+        with self.assertRaises(InvalidUsage) as cm:
+            admission.check((1000, 1000), "PNG", [], 999999, 10 ** 9)
+        self.assertEqual(cm.exception.status_code, 413)
+
+    def test_over_budget(self):
+        # decoding, reading through the 5x5 kernel, and writing the output.
+        steps = [{"op": "filter", "effect": "blur"}]
+        admission.check((1000, 1000), "PNG", steps, 10 ** 6, 27 * 10 ** 6)
+        with self.assertRaises(InvalidUsage):
+            admission.check((1000, 1000), "PNG", steps, 10 ** 6, 26 * 10 ** 6)
+
+    def test_output_too_many_pixels(self):
+        for mode in ["fill", "crop"]:
+            steps = [{"op": "thumbnail", "size": "30000,30000", "mode": mode}]
+            with self.assertRaises(InvalidUsage) as cm:
+                admission.check((269, 269), "PNG", steps, 50 * 10 ** 6, 4 * 10 ** 9)
+            self.assertEqual(cm.exception.status_code, 413)
+
+    def test_output_counted(self):
+        steps = [{"op": "thumbnail", "size": "10000,10000", "mode": "crop"}]
+        self.assertGreater(admission.estimate((269, 269), "PNG", steps), 10 ** 8)
+
+    def test_expanded_rotation_output_size(self):
+        step = {"op": "rotate", "degrees": "45", "expand": "true"}
+        self.assertEqual(admission.get_output_size((100, 100), step), (142, 142))
+        step = {"op": "rotate", "degrees": "90", "expand": "true"}
+        self.assertEqual(admission.get_output_size((200, 100), step), (100, 200))
+        step = {"op": "rotate", "degrees": "45"}
+        self.assertEqual(admission.get_output_size((200, 100), step), (200, 100))
+
+    def test_thumbnail_first_is_cheaper(self):
+        blur = {"op": "filter", "effect": "blur"}
+        thumbnail = {"op": "thumbnail", "size": "100,100"}
+        self.assertLess(
+            admission.estimate((1000, 1000), "PNG", [thumbnail, blur]),
+            admission.estimate((1000, 1000), "PNG", [blur, thumbnail]),
+        )
+
+    def test_draft_is_cheaper(self):
+        steps = [{"op": "thumbnail", "size": "100,100"}]
+        self.assertEqual(
+            admission.get_decoded_size((1000, 1000), "JPEG", steps), (125, 125)
+        )
+        self.assertEqual(
+            admission.get_decoded_size((1000, 1000), "PNG", steps), (1000, 1000)
+        )
+
+    def test_read_header_oriented(self):
+        path = os.path.join(app.config["TMP"], "oriented.jpg")
+        with open(path, "wb") as f:
+            f.write(make_jpeg(orientation=6).getvalue())
+        self.assertEqual(admission.read_header(path), ((600, 800), "JPEG"))
+
+    @mock.patch.dict(app.config, {"WORK_BUDGET": 1000})
+    def test_get_image_over_budget(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        resp = self.client.get("/image?image_id=test&filter=blur")
+        self.assertEqual(resp.status_code, 413)
+
+
+class TestBatch(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+
+    def post_jobs(self, jobs):
+        resp = self.client.post("/batch", json={"jobs": jobs})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "application/zip")
+        return zipfile.ZipFile(BytesIO(resp.data))
+
+    def test_batch(self):
+        zip_file = self.post_jobs(
+            [
+                {"image_id": "test", "thumbnail": "100,100"},
+                {"image_id": "test", "format": "jpeg", "rotate": 90},
+            ]
+        )
+        manifest = json.loads(zip_file.read("manifest.json"))
+        self.assertEqual(manifest, [{"file": "0.png"}, {"file": "1.jpeg"}])
+        self.assertEqual(Image.open(BytesIO(zip_file.read("0.png"))).size, (100, 100))
+        self.assertEqual(Image.open(BytesIO(zip_file.read("1.jpeg"))).format, "JPEG")
+
+    def test_per_job_errors(self):
+        zip_file = self.post_jobs(
+            [{"rotate": "90"}, {"image_id": "bla"}, {"image_id": "test"}]
+        )
+        manifest = json.loads(zip_file.read("manifest.json"))
+        self.assertEqual(
+            manifest[0],
+            {"error": "You must include an image_id or url get parameter."},
+        )
+        self.assertIn("error", manifest[1])
+        self.assertEqual(manifest[2], {"file": "2.png"})
+        self.assertEqual(zip_file.namelist(), ["2.png", "manifest.json"])
+
+    def test_without_jobs(self):
+        resp = self.client.post("/batch", json={})
+        self.assertEqual(resp.status_code, 400)
+
+    @mock.patch.dict(app.config, {"BATCH_MAX_JOBS": 1})
+    def test_too_many_jobs(self):
+        resp = self.client.post("/batch", json={"jobs": [{}, {}]})
+        self.assertEqual(resp.status_code, 400)
+
+
+class TestGetOriginal(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        with open("fixtures/steve.png", "rb") as f:
+            self.original = f.read()
+
+    def test_get_original(self):
+        resp = self.client.get("/images/test")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, self.original)
+        self.assertTrue(resp.headers["ETag"])
+        self.assertEqual(resp.headers["Cache-Control"], "public, max-age=86400")
+
+    def test_range(self):
+        resp = self.client.get("/images/test", headers={"Range": "bytes=0-99"})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, self.original[:100])
+
+    def test_not_modified(self):
+        etag = self.client.get("/images/test").headers["ETag"]
+        resp = self.client.get("/images/test", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_missing(self):
+        resp = self.client.get("/images/bla")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_store_files_not_served(self):
+        get_store().add_rendition("test", "thumbnail", b"rendition")
+        # Creates the index.
+        get_store().metadata("test")
+        shard = os.path.relpath(get_store().path("an_id"), app.config["IMAGES"])
+        for name in ["index.sqlite3", "renditions", shard.split(os.sep)[0]]:
+            resp = self.client.get(f"/images/{name}")
+            self.assertEqual(resp.status_code, 404, name)
+
+
+class TestRenditions(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+
+    def test_render_renditions(self):
+        render_renditions("test")
+        for preset, args in app.config["RENDITION_PRESETS"].items():
+            with Image.open(get_store().rendition_path("test", preset)) as im:
+                self.assertEqual(im.format, args["format"])
+
+    def test_rendition_served(self):
+        render_renditions("test")
+        with mock.patch("progimage.render_image") as render_mock:
+            resp = self.client.get("/image?image_id=test&thumbnail=200,200&format=png")
+        render_mock.assert_not_called()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/PNG")
+        with open(get_store().rendition_path("test", "thumbnail"), "rb") as f:
+            self.assertEqual(resp.data, f.read())
+
+    def test_rendered_when_missing(self):
+        resp = self.client.get("/image?image_id=test&thumbnail=200,200&format=png")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Image.open(BytesIO(resp.data)).format, "PNG")
+
+
+class TestGetCacheKey(TestProgImage):
+    def key(self, args):
+        return get_cache_key(mock.MagicMock(args=args), None)
+
+    def test_equivalent_requests_share_a_key(self):
+        self.assertEqual(
+            self.key({"image_id": "a", "format": "png", "rotate": "90"}),
+            self.key({"rotate": "90", "format": "PNG", "image_id": "a"}),
+        )
+
+    def test_different_requests(self):
+        self.assertNotEqual(
+            self.key({"image_id": "a", "rotate": "90"}),
+            self.key({"image_id": "a", "rotate": "180"}),
+        )
+        self.assertNotEqual(
+            self.key({"image_id": "a", "rotate": "90"}),
+            self.key({"image_id": "b", "rotate": "90"}),
+        )
+
+    def test_url_sources_keyed_by_content(self):
+        request = mock.MagicMock(args={"url": "https://images.com/an_image"})
+        self.assertEqual(
+            get_cache_key(request, "/tmp/fetched/bodies/abc"),
+            get_cache_key(request, "/tmp/fetched/bodies/abc"),
+        )
+        self.assertNotEqual(
+            get_cache_key(request, "/tmp/fetched/bodies/abc"),
+            get_cache_key(request, "/tmp/fetched/bodies/def"),
+        )
+
+
+class TestDerivedCache(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def test_miss(self):
+        cache = DerivedCache(self.directory, 100, 100)
+        self.assertIsNone(cache.get("a" * 64))
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        cache = DerivedCache(self.directory, 10, 0)
+        cache.put("a" * 64, b"aaaa", "PNG")
+        cache.put("b" * 64, b"bbbb", "PNG")
+        cache.get("a" * 64)
+        cache.put("c" * 64, b"cccc", "PNG")
+        self.assertEqual(cache.get("a" * 64), (b"aaaa", "PNG"))
+        self.assertIsNone(cache.get("b" * 64))
+
+    def test_disk_tier_shared_between_instances(self):
+        DerivedCache(self.directory, 0, 100).put("a" * 64, b"aaaa", "JPEG")
+        cache = DerivedCache(self.directory, 0, 100)
+        self.assertEqual(cache.get("a" * 64), (b"aaaa", "JPEG"))
+
+    def test_disk_tier_evicts(self):
+        cache = DerivedCache(self.directory, 0, 25)
+        cache.put("a" * 64, b"a" * 10, "PNG")
+        os.utime(cache._path("a" * 64), (0, 0))
+        cache.put("b" * 64, b"b" * 10, "PNG")
+        self.assertIsNone(cache.get("a" * 64))
+        self.assertEqual(cache.get("b" * 64), (b"b" * 10, "PNG"))
+
+    def test_disk_tier_evicts_writes_of_other_instances(self):
+        first = DerivedCache(self.directory, 0, 40)
+        second = DerivedCache(self.directory, 0, 40)
+        first.put("a" * 64, b"a" * 10, "PNG")
+        os.utime(first._path("a" * 64), (0, 0))
+        second.put("b" * 64, b"b" * 10, "PNG")
+        first.put("c" * 64, b"c" * 10, "PNG")
+        self.assertIsNone(second.get("a" * 64))
+        self.assertEqual(second.get("b" * 64), (b"b" * 10, "PNG"))
+        self.assertEqual(second.get("c" * 64), (b"c" * 10, "PNG"))
+
+
+class TestSingleFlight(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def work(self):
+        self.calls += 1
+        self.release.wait(5)
+        return b"result"
+
+    def start(self, target, count=1):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_concurrent_calls_share_one_result(self):
+        flights = SingleFlight(self.directory)
+        results = []
+        threads = self.start(lambda: results.append(flights.do("key", self.work)), 5)
+        # Give every thread time to join the flight.
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [b"result"] * 5)
+
+    def test_error_not_remembered(self):
+        flights = SingleFlight(self.directory)
+        with self.assertRaises(ValueError):
+            flights.do("key", mock.Mock(side_effect=ValueError))
+        self.assertEqual(flights.do("key", lambda: b"result"), b"result")
+
+    def test_host_lock_shared_between_instances(self):
+        locked = threading.Event()
+        acquired = threading.Event()
+
+        def hold():
+            with SingleFlight(self.directory).host_lock("key"):
+                locked.set()
+                self.release.wait(5)
+
+        def wait():
+            locked.wait(5)
+            with SingleFlight(self.directory).host_lock("key"):
+                acquired.set()
+
+        threads = self.start(hold) + self.start(wait)
+        self.assertFalse(acquired.wait(0.2))
+        self.release.set()
+        self.assertTrue(acquired.wait(5))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_host_lock_times_out(self):
+        locked = threading.Event()
+
+        def hold():
+            with SingleFlight(self.directory).host_lock("key"):
+                locked.set()
+                self.release.wait(5)
+
+        threads = self.start(hold)
+        locked.wait(5)
+        start = time.monotonic()
+        with SingleFlight(self.directory, timeout=0.2).host_lock("key"):
+            waited = time.monotonic() - start
+        self.assertGreaterEqual(waited, 0.2)
+        self.assertLess(waited, 5)
+        self.assertEqual(os.listdir(self.directory), ["key"], "Still held")
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_identical_requests_rendered_once(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        responses = []
+
+        def render(request, in_path, stream=False):
+            self.work()
+            with open("fixtures/steve.png", "rb") as f:
+                return BytesIO(f.read()), "PNG"
+
+        def get():
+            client = app.test_client()
+            responses.append(client.get("/image?image_id=test&rotate=90"))
+
+        with mock.patch("progimage.render_image", side_effect=render):
+            threads = self.start(get, 3)
+            time.sleep(0.2)
+            self.release.set()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([resp.status_code for resp in responses], [200] * 3)
+        self.assertEqual(len({resp.data for resp in responses}), 1)
+
+
+class TestEncodeStream(TestProgImage):
+    def test_read_while_written(self):
+        stream = EncodeStream()
+        first, second = stream.reader(), stream.reader()
+        stream.write(b"abc")
+        stream.write(b"")
+        self.assertEqual(first.read(2), b"ab")
+        threading.Timer(0.1, lambda: (stream.write(b"def"), stream.finish())).start()
+        self.assertEqual(first.read(), b"cdef")
+        self.assertEqual(second.read(), b"abcdef")
+        self.assertEqual(stream.getvalue(), b"abcdef")
+
+    def test_error_raised_to_readers(self):
+        stream = EncodeStream()
+        reader = stream.reader()
+        stream.write(b"abc")
+        stream.finish(ValueError("encoding failed"))
+        self.assertEqual(reader.read(3), b"abc")
+        with self.assertRaises(ValueError):
+            reader.read()
+
+    def test_done_callback(self):
+        stream = EncodeStream()
+        callback = mock.Mock()
+        stream.add_done_callback(callback)
+        callback.assert_not_called()
+        stream.finish()
+        callback.assert_called_once_with(stream)
+        stream.add_done_callback(callback)
+        self.assertEqual(callback.call_count, 2)
+
+    @mock.patch.dict(app.config, {"STREAM_MIN_PIXELS": 1})
+    def test_get_image_streamed(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        with mock.patch(
+            "progimage.save_streamed", wraps=save_streamed
+        ) as save_streamed_mock:
+            resp = self.client.get("/image?image_id=test&rotate=90&format=jpeg")
+            streamed = resp.get_data()
+        save_streamed_mock.assert_called_once()
+        self.assertEqual(resp.status_code, 200)
+        # The image is cached once it has been encoded.
+        app.extensions.pop("encode_executor").shutdown(wait=True)
+        with mock.patch("progimage.render_image") as render_mock:
+            cached = self.client.get("/image?image_id=test&rotate=90&format=jpeg")
+        render_mock.assert_not_called()
+        self.assertEqual(cached.data, streamed)
+        self.assertEqual(Image.open(BytesIO(streamed)).format, "JPEG")
+        self.assertEqual(os.listdir(os.path.join(app.config["TMP"], "flights")), [])
+
+    def test_streamed_same_as_buffered(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        images = []
+        for limit in [10 ** 12, 1]:
+            app.config["TMP"] = tempfile.mkdtemp()
+            app.extensions.pop("derived_cache", None)
+            with mock.patch.dict(app.config, {"STREAM_MIN_PIXELS": limit}):
+                images.append(self.client.get("/image?image_id=test").data)
+        self.assertEqual(images[0], images[1])
+
+    @mock.patch.dict(app.config, {"STREAM_MIN_PIXELS": 10 ** 9})
+    def test_small_image_not_streamed(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/test")
+        with mock.patch("progimage.save_streamed") as save_streamed_mock:
+            resp = self.client.get("/image?image_id=test&rotate=90&format=jpeg")
+        save_streamed_mock.assert_not_called()
+        self.assertEqual(Image.open(BytesIO(resp.data)).format, "JPEG")
+
 
 class TestGetInPath(TestProgImage):
     def test_without_image_args(self):
@@ -100,20 +835,91 @@ class TestGetInPath(TestProgImage):
             get_in_path(request)
 
     def test_with_image_id(self):
+        shutil.copyfile("fixtures/steve.png", f"{app.config['IMAGES']}/fake_id")
         request = mock.MagicMock(args={"image_id": "fake_id"})
         path = get_in_path(request)
-        self.assertEqual(path, f"{app.config['IMAGES']}/fake_id")
+        self.assertEqual(path, get_store().path("fake_id"))
+        self.assertTrue(path.startswith(app.config["IMAGES"]))
 
-    @mock.patch("requests.get")
+    def test_with_missing_image_id(self):
+        request = mock.MagicMock(args={"image_id": "fake_id"})
+        with self.assertRaises(InvalidUsage) as context:
+            get_in_path(request)
+        self.assertEqual(context.exception.status_code, 404)
+
+    @mock.patch("requests.Session.get")
     def test_with_url(self, get_mock):
-        mock_return_value = mock.MagicMock()
-        mock_return_value.content = b"some content"
-        get_mock.return_value = mock_return_value
+        get_mock.return_value = fake_response(b"some content")
         request = mock.MagicMock(args={"url": "https://images.com/an_image"})
         path = get_in_path(request)
-        get_mock.assert_called_with("https://images.com/an_image")
-        self.assertEqual(type(path).__name__, "BytesIO")
-        self.assertEqual(path.read(), b"some content")
+        self.assertEqual(get_mock.call_args[0][0], "https://images.com/an_image")
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"some content")
+
+
+def fake_response(content, status_code=200, headers=None):
+    response = mock.MagicMock(status_code=status_code, headers=headers or {})
+    response.iter_content.return_value = [content]
+    return response
+
+
+class TestRemoteFetcher(TestProgImage):
+    url = "https://images.com/an_image"
+
+    def setUp(self):
+        super().setUp()
+        self.fetcher = RemoteFetcher(
+            tempfile.mkdtemp(), max_bytes=100, disk_limit=1000, max_age=60, timeout=1
+        )
+        self.get_mock = mock.MagicMock()
+        self.fetcher.session.get = self.get_mock
+
+    def test_fetched_once(self):
+        self.get_mock.return_value = fake_response(b"some content")
+        first = self.fetcher.fetch(self.url)
+        second = self.fetcher.fetch(self.url)
+        self.assertEqual(first, second)
+        self.get_mock.assert_called_once()
+        self.assertTrue(self.get_mock.call_args[1]["stream"])
+
+    def test_named_by_content(self):
+        self.get_mock.return_value = fake_response(b"some content")
+        path = self.fetcher.fetch(self.url)
+        self.assertEqual(
+            os.path.basename(path), hashlib.sha256(b"some content").hexdigest()
+        )
+
+    def test_revalidated_when_stale(self):
+        self.get_mock.return_value = fake_response(
+            b"some content", headers={"ETag": '"v1"'}
+        )
+        first = self.fetcher.fetch(self.url)
+        self.fetcher.max_age = 0
+        self.get_mock.return_value = fake_response(b"", status_code=304)
+        second = self.fetcher.fetch(self.url)
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.get_mock.call_args[1]["headers"], {"If-None-Match": '"v1"'}
+        )
+
+    def test_too_large(self):
+        self.get_mock.return_value = fake_response(b"x" * 101)
+        with self.assertRaises(InvalidUsage) as cm:
+            self.fetcher.fetch(self.url)
+        self.assertEqual(cm.exception.status_code, 413)
+        self.assertEqual(os.listdir(f"{self.fetcher.directory}/bodies"), [])
+
+    def test_too_large_content_length(self):
+        response = fake_response(b"", headers={"Content-Length": "101"})
+        self.get_mock.return_value = response
+        with self.assertRaises(InvalidUsage):
+            self.fetcher.fetch(self.url)
+        response.iter_content.assert_not_called()
+
+    def test_error_status(self):
+        self.get_mock.return_value = fake_response(b"", status_code=404)
+        with self.assertRaises(InvalidUsage):
+            self.fetcher.fetch(self.url)
 
 
 class TestConvertImage(TestProgImage):
@@ -189,6 +995,37 @@ class TestGetFileConversionArgs(TestProgImage):
             file_conversion_args, {"format": "JPEG", "quality": 75},
         )
 
+    def test_encoder_preset(self):
+        request = mock.MagicMock(args={"format": "JPEG", "preset": "small"})
+        self.assertEqual(
+            get_file_conversion_args(request, None),
+            {"format": "JPEG", "quality": 70, "optimize": True, "progressive": True},
+        )
+
+    def test_args_used_over_preset(self):
+        request = mock.MagicMock(args={"format": "png", "preset": "fast"})
+        request.args["compress_level"] = "9"
+        self.assertEqual(
+            get_file_conversion_args(request, None),
+            {"format": "png", "compress_level": 9},
+        )
+
+    def test_unknown_preset(self):
+        request = mock.MagicMock(args={"format": "PNG", "preset": "tiny"})
+        with self.assertRaises(InvalidUsage):
+            get_file_conversion_args(request, None)
+
+    def test_progressive(self):
+        request = mock.MagicMock(args={"format": "jpeg", "progressive": "true"})
+        self.assertEqual(
+            get_file_conversion_args(request, None),
+            {"format": "jpeg", "progressive": True},
+        )
+
+    def test_progressive_ignored_for_png(self):
+        request = mock.MagicMock(args={"format": "PNG", "progressive": "true"})
+        self.assertEqual(get_file_conversion_args(request, None), {"format": "PNG"})
+
 
 class TestSave(TestProgImage):
     def test_convert_rgba_to_jpeg(self):
@@ -213,6 +1050,413 @@ class TestSave(TestProgImage):
         self.assertEqual(file_conversion_kwargs, {"format": "PNG", "compress_level": 8})
 
 
+class TestRenderImage(TestProgImage):
+    @mock.patch("progimage.get_in_path", return_value="fixtures/steve.png")
+    def test_encodes_once_in_requested_format(self, get_in_path_mock):
+        request = mock.MagicMock(
+            args={"format": "JPEG", "mask": "ellipse", "thumbnail": "50,50"}
+        )
+        buffer, file_format = render_image(request)
+        im = Image.open(buffer)
+        self.assertEqual(file_format, "JPEG")
+        self.assertEqual(im.format, "JPEG")
+        self.assertEqual(im.size, (50, 50))
+
+    @mock.patch("pipeline.flatten")
+    def test_mask_composited_for_lowercase_format(self, flatten_mock):
+        request = mock.MagicMock(args={"format": "jpeg", "mask": "ellipse"})
+        buffer, _ = render_image(request, "fixtures/steve.png")
+        self.assertEqual(Image.open(buffer).format, "JPEG")
+        flatten_mock.assert_not_called()
+
+    def test_ops_run_in_order(self):
+        ops = [
+            {"op": "filter", "effect": "blur"},
+            {"op": "rotate", "degrees": "45"},
+            {"op": "thumbnail", "size": "100,100"},
+        ]
+        request = mock.MagicMock(args={"format": "PNG", "ops": json.dumps(ops)})
+        buffer, _ = render_image(request, "fixtures/steve.png")
+        with Image.open("fixtures/steve.png") as im:
+            in_order = pipeline.run(im.copy(), get_steps(request.args))
+            planned = pipeline.run(im.copy(), pipeline.plan(get_steps(request.args)))
+        rendered = Image.open(buffer)
+        self.assertEqual(rendered.tobytes(), in_order.tobytes())
+        self.assertNotEqual(rendered.tobytes(), planned.tobytes())
+
+
+class TestGetSteps(TestProgImage):
+    def test_no_steps(self):
+        self.assertEqual(get_steps({}), [])
+
+    def test_steps_use_service_arg_names(self):
+        steps = get_steps({"thumbnail": "10,10", "rotate": "90"})
+        self.assertEqual(
+            steps,
+            [{"op": "rotate", "degrees": "90"}, {"op": "thumbnail", "size": "10,10"}],
+        )
+
+    def test_ops_keep_their_order(self):
+        ops = [
+            {"op": "thumbnail", "size": "10,10"},
+            {"op": "filter", "effect": "blur"},
+            {"op": "rotate", "degrees": 90},
+            {"op": "filter", "effect": "sharpen"},
+        ]
+        self.assertEqual(
+            get_steps({"ops": json.dumps(ops)}),
+            [
+                {"op": "thumbnail", "size": "10,10"},
+                {"op": "filter", "effect": "blur"},
+                {"op": "rotate", "degrees": "90"},
+                {"op": "filter", "effect": "sharpen"},
+            ],
+        )
+
+    def test_ops_with_zero_values(self):
+        self.assertEqual(
+            get_steps({"ops": '[{"op": "rotate", "degrees": 0}]'}),
+            [{"op": "rotate", "degrees": "0"}],
+        )
+
+    def test_invalid_ops(self):
+        for ops in [
+            "not json",
+            '{"op": "rotate"}',
+            '["rotate"]',
+            '[{"op": "resize", "size": "10,10"}]',
+            '[{"op": "rotate"}]',
+            '[{"op": "rotate", "degrees": ""}]',
+        ]:
+            with self.subTest(ops=ops), self.assertRaises(InvalidUsage):
+                get_steps({"ops": ops})
+
+    def test_options(self):
+        self.assertEqual(
+            get_steps({"mask": "ellipse", "feather": "4"}),
+            [{"op": "mask", "shape": "ellipse", "feather": "4"}],
+        )
+        self.assertEqual(
+            get_steps({"ops": '[{"op": "mask", "shape": "ellipse", "feather": 4}]'}),
+            [{"op": "mask", "shape": "ellipse", "feather": "4"}],
+        )
+
+    def test_filter_options(self):
+        self.assertEqual(
+            get_steps({"filter": "gaussianblur", "radius": "4"}),
+            [{"op": "filter", "effect": "gaussianblur", "radius": "4"}],
+        )
+
+    def test_invalid_filters(self):
+        for args in [
+            {"filter": "bogus"},
+            {"filter": "type_checking"},
+            {"filter": "gaussianblur", "radius": "abc"},
+            {"filter": "gaussianblur", "radius": "inf"},
+            {"filter": "unsharpmask", "percent": "1.5"},
+            {"ops": '[{"op": "filter", "effect": "unsharpmask", "threshold": "x"}]'},
+        ]:
+            with self.assertRaises(InvalidUsage) as cm:
+                get_steps(args)
+            self.assertEqual(cm.exception.status_code, 400)
+
+    def test_invalid_thumbnails(self):
+        for args in [
+            {"thumbnail": "100,100", "mode": "stretch"},
+            {"thumbnail": "100"},
+            {"thumbnail": "0,100"},
+            {"thumbnail": "100,100", "resample": "foo"},
+            {"thumbnail": "100,100", "reducing_gap": "x"},
+            {"thumbnail": "100,100", "reducing_gap": "0.5"},
+            {"ops": '[{"op": "thumbnail", "size": "100,100", "mode": "bogus"}]'},
+        ]:
+            with self.assertRaises(InvalidUsage) as cm:
+                get_steps(args)
+            self.assertEqual(cm.exception.status_code, 400)
+
+    def test_invalid_rotations(self):
+        for args in [
+            {"rotate": "abc"},
+            {"rotate": "nan"},
+            {"rotate": "45", "resample": "bogus"},
+            {"ops": '[{"op": "rotate", "degrees": "ninety"}]'},
+        ]:
+            with self.assertRaises(InvalidUsage) as cm:
+                get_steps(args)
+            self.assertEqual(cm.exception.status_code, 400)
+
+    def test_thumbnail_too_many_pixels(self):
+        with self.assertRaises(InvalidUsage) as cm:
+            get_steps({"thumbnail": "30000,30000", "mode": "fill"})
+        self.assertEqual(cm.exception.status_code, 413)
+
+    @mock.patch.dict(app.config, {"THUMBNAIL_BUCKETS": [100, 200, 400]})
+    def test_thumbnail_buckets(self):
+        self.assertEqual(
+            get_steps({"thumbnail": "150,1000", "mode": "crop"}),
+            [{"op": "thumbnail", "size": "200,400", "mode": "crop"}],
+        )
+
+    def test_ops_with_other_transformations(self):
+        with self.assertRaises(InvalidUsage):
+            get_steps(
+                {"ops": '[{"op": "rotate", "degrees": "90"}]', "filter": "blur"}
+            )
+
+
+class TestPipeline(TestProgImage):
+    def setUp(self):
+        super().setUp()
+        self.im = Image.open("fixtures/steve.png")
+
+    def tearDown(self):
+        self.im.close()
+
+    def test_no_steps(self):
+        self.assertIs(pipeline.run(self.im, []), self.im)
+
+    def test_chain(self):
+        im = pipeline.run(
+            self.im.convert("RGB"),
+            [
+                {"op": "filter", "effect": "blur"},
+                {"op": "mask", "shape": "ellipse"},
+                {"op": "rotate", "degrees": "45"},
+                {"op": "thumbnail", "size": "100,100"},
+            ],
+        )
+        self.assertEqual(im.mode, "RGBA", "The mask adds an alpha channel")
+        self.assertEqual(im.size, (100, 100))
+
+    def test_mask_composited_for_opaque_formats(self):
+        im = pipeline.run(
+            self.im.convert("RGB"), [{"op": "mask", "shape": "ellipse"}], "JPEG"
+        )
+        self.assertEqual(im.mode, "RGB")
+        self.assertGreater(
+            min(im.getpixel((0, 0))), 240, "Outside the shape fades to white"
+        )
+
+    @mock.patch("pipeline.STRIP_PIXELS", 269 * 20)
+    def test_filter_in_strips(self):
+        im = self.im.convert("RGB")
+        for effect in ["blur", "smooth_more", "emboss"]:
+            with self.subTest(effect=effect):
+                expected = im.filter(getattr(ImageFilter, effect.upper()))
+                strips = pipeline.filter_image(im.copy(), effect)
+                self.assertEqual(strips.tobytes(), expected.tobytes())
+
+    @mock.patch("pipeline.STRIP_PIXELS", 269 * 20)
+    @mock.patch("pipeline.PARALLEL_PIXELS", 0)
+    @mock.patch("pipeline.FILTER_WORKERS", 4)
+    def test_filter_in_parallel(self):
+        im = self.im.convert("RGB")
+        for effect, params, image_filter in [
+            ("blur", {}, ImageFilter.BLUR),
+            ("gaussianblur", {"radius": "3.5"}, ImageFilter.GaussianBlur(3.5)),
+            ("unsharpmask", {"percent": "200"}, ImageFilter.UnsharpMask(percent=200)),
+        ]:
+            with self.subTest(effect=effect):
+                strips = pipeline.filter_image(im.copy(), effect, **params)
+                self.assertEqual(strips.tobytes(), im.filter(image_filter).tobytes())
+
+    def test_parameterised_filters(self):
+        image_filter = pipeline.get_filter("GaussianBlur", radius="5")
+        self.assertEqual(image_filter.radius, 5.0)
+        image_filter = pipeline.get_filter("unsharpmask", radius="1", threshold="0")
+        self.assertEqual(
+            (image_filter.radius, image_filter.percent, image_filter.threshold),
+            (1.0, 150, 0),
+        )
+
+    def test_right_angles_transposed(self):
+        im = self.im.crop((0, 0, 200, 100))
+        with mock.patch.object(Image.Image, "rotate") as rotate_mock:
+            rotated = pipeline.rotate_image(im, "90", expand="true")
+            self.assertEqual(pipeline.rotate_image(im, "-180").size, (200, 100))
+        self.assertFalse(rotate_mock.called)
+        self.assertEqual(rotated.size, (100, 200))
+        self.assertIs(pipeline.rotate_image(im, "360"), im)
+
+    def test_rotate_options(self):
+        im = self.im.convert("RGB")
+        rotated = pipeline.rotate_image(im, "45.5", expand="1", resample="bicubic")
+        self.assertGreater(rotated.width, im.width)
+        self.assertEqual(pipeline.rotate_image(im, "45.5").size, im.size)
+
+    def test_orient(self):
+        im = Image.new("RGB", (200, 100))
+        exif = im.getexif()
+        exif[pipeline.EXIF_ORIENTATION] = 6
+        buffer = BytesIO()
+        im.save(buffer, "JPEG", exif=exif.tobytes())
+        with Image.open(buffer) as im:
+            self.assertEqual(pipeline.orient(im).size, (100, 200))
+        self.assertIs(pipeline.orient(self.im), self.im)
+
+    def test_thumbnail_modes(self):
+        im = self.im.crop((0, 0, 200, 100))
+        sizes = {"fit": (100, 50), "fill": (100, 100), "crop": (100, 100)}
+        for mode, size in sizes.items():
+            with self.subTest(mode=mode):
+                thumbnail = pipeline.thumbnail_image(im.copy(), "100,100", mode)
+                self.assertEqual(thumbnail.size, size)
+
+    def test_thumbnail_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            pipeline.thumbnail_image(Image.new("RGB", (10, 10)), "5,5", "stretch")
+
+    def test_thumbnail_fill_pads(self):
+        im = Image.new("RGB", (200, 100))
+        thumbnail = pipeline.thumbnail_image(im, "100,100", "fill")
+        self.assertEqual(thumbnail.getpixel((50, 0)), (255, 255, 255))
+        self.assertEqual(thumbnail.getpixel((50, 50)), (0, 0, 0))
+
+    def test_thumbnail_resampling(self):
+        im = self.im.convert("RGB")
+        fast = pipeline.thumbnail_image(im.copy(), "50,50", resample="nearest")
+        full = pipeline.thumbnail_image(im.copy(), "50,50", reducing_gap="0")
+        self.assertEqual(fast.size, full.size)
+        self.assertNotEqual(fast.tobytes(), full.tobytes())
+
+    @mock.patch("pipeline.STRIP_PIXELS", 269 * 20)
+    def test_flatten(self):
+        im = self.im.copy()
+        expected = Image.new("RGB", im.size, (255, 255, 255))
+        expected.paste(im, mask=im.getchannel("A"))
+        self.assertEqual(pipeline.flatten(im).tobytes(), expected.tobytes())
+
+    def test_mask_templates_cached(self):
+        pipeline.get_mask.cache_clear()
+        pipeline.mask_image(self.im.convert("RGB"), "ellipse")
+        pipeline.mask_image(self.im.convert("RGB"), "ellipse")
+        self.assertEqual(pipeline.get_mask.cache_info().hits, 1)
+
+    @mock.patch("pipeline.MASK_CACHE_PIXELS", 100 * 100)
+    def test_large_masks_not_cached(self):
+        pipeline.get_mask.cache_clear()
+        pipeline.get_inverse_mask.cache_clear()
+        im = self.im.convert("RGB")
+        masked = pipeline.mask_image(im.copy(), "ellipse")
+        flattened = pipeline.mask_image(im.copy(), "ellipse", background=(0, 0, 0))
+        self.assertEqual(pipeline.get_mask.cache_info().currsize, 0)
+        self.assertEqual(pipeline.get_inverse_mask.cache_info().currsize, 0)
+        expected = pipeline.get_mask(im.size, "ellipse")
+        self.assertEqual(masked.getchannel("A").tobytes(), expected.tobytes())
+        im.paste((0, 0, 0), mask=pipeline.get_inverse_mask(im.size, "ellipse"))
+        self.assertEqual(flattened.tobytes(), im.tobytes())
+
+    def test_feathered_mask(self):
+        sharp = pipeline.get_mask((100, 100), "rectangle")
+        feathered = pipeline.get_mask((100, 100), "rectangle", 4.0)
+        self.assertEqual(sharp.getpixel((8, 50)), 10)
+        self.assertGreater(feathered.getpixel((8, 50)), 10)
+
+
+class TestPlan(TestProgImage):
+    def test_thumbnail_moved_first(self):
+        steps = [
+            {"op": "mask", "shape": "ellipse"},
+            {"op": "rotate", "degrees": "45"},
+            {"op": "thumbnail", "size": "200,200"},
+        ]
+        self.assertEqual(pipeline.plan(steps), steps[-1:] + steps[:-1])
+
+    def test_thumbnail_kept_after_filter(self):
+        steps = [
+            {"op": "filter", "effect": "blur"},
+            {"op": "mask", "shape": "ellipse"},
+            {"op": "thumbnail", "size": "200,200"},
+        ]
+        self.assertEqual(pipeline.plan(steps), [steps[0], steps[2], steps[1]])
+
+    def test_cropped_thumbnail_kept_in_place(self):
+        steps = [
+            {"op": "mask", "shape": "ellipse"},
+            {"op": "thumbnail", "size": "200,100", "mode": "crop"},
+        ]
+        self.assertEqual(pipeline.plan(steps), steps)
+
+    def test_thumbnail_kept_after_expanding_rotation(self):
+        steps = [
+            {"op": "rotate", "degrees": "45", "expand": "true"},
+            {"op": "thumbnail", "size": "200,100"},
+        ]
+        self.assertEqual(pipeline.plan(steps), steps)
+
+    def test_order_otherwise_kept(self):
+        steps = [
+            {"op": "rotate", "degrees": "45"},
+            {"op": "filter", "effect": "blur"},
+        ]
+        self.assertEqual(pipeline.plan(steps), steps)
+
+
+def make_jpeg(orientation=1):
+    exif = Image.Exif()
+    exif[pipeline.EXIF_ORIENTATION] = orientation
+    buffer = BytesIO()
+    Image.new("RGB", (800, 600)).save(buffer, format="JPEG", exif=exif.tobytes())
+    buffer.seek(0)
+    return buffer
+
+
+class TestDraft(TestProgImage):
+    def open_jpeg(self, orientation=1):
+        return Image.open(make_jpeg(orientation))
+
+    def test_jpeg_decoded_smaller(self):
+        im = self.open_jpeg()
+        pipeline.draft(im, [{"op": "thumbnail", "size": "200,200"}])
+        im.load()
+        self.assertEqual(im.size, (400, 300), "The largest scale that fits 200x200")
+
+    def test_oriented_jpeg(self):
+        im = self.open_jpeg(orientation=6)
+        pipeline.draft(im, [{"op": "thumbnail", "size": "200,50", "mode": "crop"}])
+        im.load()
+        self.assertEqual(
+            pipeline.orient(im).size, (300, 400), "Still covers 200x50 once turned"
+        )
+
+    def test_not_first_step(self):
+        im = self.open_jpeg()
+        pipeline.draft(
+            im,
+            [
+                {"op": "mask", "shape": "ellipse"},
+                {"op": "thumbnail", "size": "200,200"},
+            ],
+        )
+        im.load()
+        self.assertEqual(im.size, (800, 600))
+
+
+class TestTransformRemotely(TestProgImage):
+    @mock.patch("progimage.apply_transformations")
+    def test_encoded_once_at_the_end(self, apply_mock):
+        def apply_transformations(request, buffer, file_format, intermediate):
+            self.assertEqual(Image.open(buffer).format, "PNG")
+            self.assertEqual(file_format, "PNG")
+            self.assertTrue(intermediate)
+            buffer.seek(0)
+            return buffer
+
+        apply_mock.side_effect = apply_transformations
+        request = mock.MagicMock(args={"format": "JPEG", "rotate": "90"})
+        buffer, file_format = transform_remotely(request, "fixtures/steve.png")
+        apply_mock.assert_called_once()
+        self.assertEqual(file_format, "JPEG")
+        self.assertEqual(Image.open(buffer).format, "JPEG")
+
+    @mock.patch("progimage.apply_transformations")
+    def test_without_transformations(self, apply_mock):
+        request = mock.MagicMock(args={"format": "JPEG"})
+        buffer, file_format = transform_remotely(request, "fixtures/steve.png")
+        apply_mock.assert_not_called()
+        self.assertEqual(Image.open(buffer).format, "JPEG")
+
+
 class TestApplyTransformations(TestProgImage):
     def test_no_transformations_in_request(self):
         request = mock.MagicMock(args={})
@@ -223,7 +1467,7 @@ class TestApplyTransformations(TestProgImage):
             "As no transformations are applied the buffer should be unchanged",
         )
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_rotation(self, post_mock):
         post_mock.return_value.content = b"bar"
         request = mock.MagicMock(args={"rotate": "90"})
@@ -233,3 +1477,55 @@ class TestApplyTransformations(TestProgImage):
         post_mock.assert_called_with(
             "http://rotate:5001/rotate?degrees=90", files={"file": buffer}
         )
+
+    @mock.patch.dict(app.config, {"TRANSFORM_TRANSPORT": "raw"})
+    @mock.patch("requests.Session.post")
+    def test_raw_transport(self, post_mock):
+        post_mock.return_value.content = b"bar"
+        request = mock.MagicMock(args={"rotate": "90"})
+        buffer = BytesIO(b"foo")
+        apply_transformations(request, buffer, "PNG")
+        post_mock.assert_called_with(
+            "http://rotate:5001/rotate?degrees=90",
+            data=buffer,
+            headers={
+                "Content-Type": "application/octet-stream",
+                "X-Image-Format": "PNG",
+            },
+        )
+
+    @mock.patch("requests.Session.post")
+    def test_intermediate(self, post_mock):
+        post_mock.return_value.content = b"bar"
+        request = mock.MagicMock(args={"rotate": "90"})
+        buffer = BytesIO(b"foo")
+        apply_transformations(request, buffer, "PNG", intermediate=True)
+        post_mock.assert_called_with(
+            "http://rotate:5001/rotate?degrees=90",
+            files={"file": buffer},
+            headers={"X-Intermediate": "1"},
+        )
+
+    @mock.patch("requests.Session.post")
+    def test_consecutive_ops_grouped(self, post_mock):
+        post_mock.return_value.content = b"bar"
+        ops = [
+            {"op": "filter", "effect": "blur"},
+            {"op": "filter", "effect": "sharpen"},
+            {"op": "rotate", "degrees": "90"},
+        ]
+        request = mock.MagicMock(args={"ops": json.dumps(ops)})
+        apply_transformations(request, BytesIO(b"foo"))
+        urls = [call[0][0] for call in post_mock.call_args_list]
+        self.assertEqual(
+            urls,
+            [
+                "http://filter:5003/ops?"
+                + urllib.parse.urlencode({"ops": json.dumps(ops[:2])}),
+                "http://rotate:5001/rotate?degrees=90",
+            ],
+        )
+
+    def test_sessions_reused(self):
+        self.assertIs(get_transform_session("rotate"), get_transform_session("rotate"))
+        self.assertIsNot(get_transform_session("rotate"), get_transform_session("mask"))
@@ -1,9 +1,13 @@
-import io
-
-from flask import Flask, request, redirect, send_file
+from flask import Flask, request
 from PIL import Image
 
+import metrics
+import service
+
 app = Flask(__name__)
+metrics.init_app(app)
+# Images with more pixels than this are rejected before they are decoded.
+app.config["MAX_IMAGE_PIXELS"] = 50 * 1000 * 1000
 
 
 @app.route("/")
@@ -11,21 +15,29 @@ def hello_world():
     return "Hello, rotate!"
 
 
+@app.errorhandler(Image.DecompressionBombError)
+def decompression_bomb(error):
+    return str(error), 413
+
+
 @app.route("/rotate", methods=["POST"])
 def rotate():
-    degrees = request.args.get("degrees")
-    if "file" not in request.files:
-        print("No file part")
-        return redirect(request.url)
-    file = request.files["file"]
-    if file.filename == "":
-        print("No selected file")
-        return redirect(request.url)
-    # _, _, file_format = file.filename.partition(".")
-    f = io.BytesIO()
-    file_format = None
-    with Image.open(file) as im:
-        file_format = im.format
-        im.rotate(int(degrees)).save(f, format=file_format)
-        f.seek(0)
-    return send_file(f, mimetype=f"image/{file_format}")
+    """
+    Rotates the image anticlockwise by degrees, optionally growing the canvas
+    to fit it with expand, and with the nearest, bilinear or bicubic resample.
+    """
+    op = {"degrees": request.args.get("degrees")}
+    for name in ["expand", "resample"]:
+        if request.args.get(name):
+            op[name] = request.args.get(name)
+    return service.transform("rotate", [op], orient=True)
+
+
+@app.route("/ops", methods=["POST"])
+def ops():
+    """
+    Applies several rotations in one request. The ops query arg is a json list
+    of them in the order they are applied, for example
+    [{"op": "rotate", "degrees": 90}, {"op": "rotate", "degrees": 45}]
+    """
+    return service.transform("rotate", service.get_ops("rotate"), orient=True)
@@ -1,9 +1,14 @@
-import io
-
-from flask import Flask, request, redirect, send_file
+from flask import abort, Flask, request
 from PIL import Image
 
+import metrics
+import pipeline
+import service
+
 app = Flask(__name__)
+metrics.init_app(app)
+# Images with more pixels than this are rejected before they are decoded.
+app.config["MAX_IMAGE_PIXELS"] = 50 * 1000 * 1000
 
 
 @app.route("/")
@@ -11,21 +16,47 @@ def hello_world():
     return "Hello, thumbnail!"
 
 
+@app.errorhandler(Image.DecompressionBombError)
+def decompression_bomb(error):
+    return str(error), 413
+
+
 @app.route("/thumbnail", methods=["POST"])
 def thumbnail():
-    size = tuple(int(part) for part in request.args.get("size").split(","))
-    if "file" not in request.files:
-        print("No file part")
-        return redirect(request.url)
-    file = request.files["file"]
-    if file.filename == "":
-        print("No selected file")
-        return redirect(request.url)
-    f = io.BytesIO()
-    file_format = None
-    with Image.open(file) as im:
-        file_format = im.format
-        im.thumbnail(size)
-        im.save(f, format=file_format)
-        f.seek(0)
-    return send_file(f, mimetype=f"image/{file_format}")
+    """
+    Shrinks the image to the size. The mode, resample and reducing_gap query
+    args are passed on to thumbnail_image.
+    """
+    op = {"size": request.args.get("size")}
+    for name in ["mode", "resample", "reducing_gap"]:
+        if request.args.get(name):
+            op[name] = request.args.get(name)
+    return transform([op])
+
+
+@app.route("/ops", methods=["POST"])
+def ops():
+    """
+    Applies several thumbnails in one request. The ops query arg is a json
+    list of them in the order they are applied, for example
+    [{"op": "thumbnail", "size": "800,800"}, {"op": "thumbnail", "size": "200,200"}]
+    """
+    return transform(service.get_ops("thumbnail"))
+
+
+def transform(ops):
+    for op in ops:
+        check_op(op)
+    return service.transform("thumbnail", ops)
+
+
+def check_op(op):
+    """
+    Padded and cropped thumbnails are made at exactly their size, so it is
+    held to the same limit as the images themselves.
+    """
+    try:
+        pipeline.check_step(dict(op, op="thumbnail"))
+    except ValueError as error:
+        abort(400, str(error))
+    service.check_pixels(*pipeline.parse_size(str(op["size"])))